@@ -0,0 +1,142 @@
+#!/usr/bin/python
+# Written in Python 3.8 in 2023 by A.L.O. Gaenssle
+
+# BENCHMARK: PARSING KEGG FLAT FILES
+# -> compares the previous line-list parser with the streaming parser of Download_KEGG
+# -> uses synthetic KEGG-get responses (Fixtures, random entries in the format of rest.kegg.jp/get)
+# -> checks that both parsers return the same data before timing them
+
+import os
+import re
+import io
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import Download_KEGG as KEGG
+
+FixtureFolder = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Fixtures")
+
+
+##-------------------------------------------------------------------------------------------------
+## PREVIOUS PARSER (for comparison) ---------------------------------------------------------------
+##-------------------------------------------------------------------------------------------------
+## ================================================================================================
+## Split the complete response into lists of lines per entry
+def SplitEntries(Download):
+	Data = []
+	Entry = []
+	for Line in Download.split("\n"):
+		if Line.startswith("///"):
+			Data.append(Entry)
+			Entry = []
+		else:
+			Entry.append(Line)
+	return(Data)
+
+## ================================================================================================
+## Read each line of the entry
+def GetDetailedDataPrevious(Entry, GeneID, orgID):
+	Dict = {"Ref": GeneID,"ID": orgID, "orgID": orgID,"Sequence": ""}
+	Name = ""
+	inAASeq = False
+	for Line in Entry:
+		Line = re.sub(r"\s\s+" , " ", Line)
+		Line = Line.strip()
+		if inAASeq == True:
+			if Line.startswith("NTSEQ"):
+				break
+			else:
+				Dict["Sequence"] += Line.strip()
+		if inAASeq == False:
+			if Line.startswith("ENTRY"):
+				Name = Line.split(" ",2)[1]
+			elif Line.startswith("NAME"):
+				Dict["Name"] = Line.split(" ",1)[1].replace("(GenBank)", "").strip()
+			elif Line.startswith("ORTHOLOGY"):
+				Dict["KO-ID"] = Line.split(" ",2)[1].strip()
+			elif Line.startswith("ORGANISM") or Line.startswith("VIRUS"):
+				Line = Line.split(" ",1)[1].strip()
+				Dict["orgID"] = Line.split(" ",1)[0]
+				Dict["Organism"] = Line.split(" ",1)[1]
+			elif Line.startswith("MOTIF"):
+				Dict["Domain"] = Line.split(" ",1)[1].replace("Pfam:", "").strip()
+			elif "UniProt" in Line:
+				Dict["UniProt"] = Line.split(" ",1)[1]
+			elif Line.startswith("AASEQ"):
+				Dict["Length"] = Line.split(" ",1)[1]
+				inAASeq = True
+	Dict["ID"] = Dict["orgID"] + ":" + Name
+	return(Dict)
+
+
+##-------------------------------------------------------------------------------------------------
+## BENCHMARK FUNCTIONS ----------------------------------------------------------------------------
+##-------------------------------------------------------------------------------------------------
+## ================================================================================================
+## Parse the response as before: decode all, split into lines and entries, then parse
+def ParsePrevious(Response):
+	Download = Response.read().decode("utf-8")
+	return([GetDetailedDataPrevious(Entry, None, None) for Entry in SplitEntries(Download)])
+
+## ================================================================================================
+## Parse the response while reading it (as in Download_KEGG.DownloadProteinEntries)
+def ParseStreaming(Response, Fields=None):
+	Lines = io.TextIOWrapper(Response, encoding="utf-8")
+	return([KEGG.GetDetailedData(Entry, None, None, Fields) for Entry in KEGG.IterEntries(Lines)])
+
+## ================================================================================================
+## Return the best time (seconds) of several repeats
+def TimeFunction(Function, Data, Repeats, *Args):
+	Best = None
+	for i in range(Repeats):
+		Start = time.perf_counter()
+		Function(io.BytesIO(Data), *Args)
+		Duration = time.perf_counter() - Start
+		if Best is None or Duration < Best:
+			Best = Duration
+	return(Best)
+
+## ================================================================================================
+## Load all fixtures into one response (repeated to the given number of entries)
+def LoadResponse(Entries):
+	Data = b""
+	for File in sorted(os.listdir(FixtureFolder)):
+		if File.startswith("Synthetic_KEGG_Get_"):
+			with open(os.path.join(FixtureFolder, File), "rb") as Fixture:
+				Data += Fixture.read()
+	Count = Data.count(b"\n///")
+	return(Data * max(1, Entries // Count), max(1, Entries // Count) * Count)
+
+
+##-------------------------------------------------------------------------------------------------
+## SCRIPT -----------------------------------------------------------------------------------------
+##-------------------------------------------------------------------------------------------------
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Benchmark of the KEGG flat file parser")
+	parser.add_argument("-e", "--entries",
+		help="number of entries parsed per repeat (default: %(default)s)",
+		default=20000,
+		type=int)
+	parser.add_argument("-r", "--repeats",
+		help="number of repeats, the best time is reported (default: %(default)s)",
+		default=5,
+		type=int)
+	args = parser.parse_args()
+
+	Data, Entries = LoadResponse(args.entries)
+	Previous = ParsePrevious(io.BytesIO(Data))
+	Streaming = ParseStreaming(io.BytesIO(Data))
+	if Previous != Streaming:
+		print("The parsers return different data!")
+		quit(1)
+
+	NoSequence = tuple(Field for Field in KEGG.AllFields if Field != "Sequence")
+	Results = [("previous", TimeFunction(ParsePrevious, Data, args.repeats)),
+		("streaming", TimeFunction(ParseStreaming, Data, args.repeats)),
+		("streaming without sequence", TimeFunction(ParseStreaming, Data, args.repeats, NoSequence))]
+	print(f"Parsed {Entries} entries ({len(Data)/1024/1024:.1f} MB), best of {args.repeats}:")
+	for Name, Duration in Results:
+		print(f"{Name:<30}{Duration:>8.3f} s{Entries/Duration:>12.0f} entries/s"
+			f"{Results[0][1]/Duration:>8.1f}x")
@@ -0,0 +1,292 @@
+#!/usr/bin/python
+# Written in Python 3.8 in 2023 by A.L.O. Gaenssle
+
+# BENCHMARK: ALL COMPONENTS AND THE COMPLETE RUN (offline, with a local KEGG stub server)
+# -> micro benchmarks: neighbor indices, gene order, parser, target matching, counting,
+#    export and combining fragments (on synthetic neighbor tables, e.g. 10k to 1M rows)
+# -> end-to-end: download the neighbors of a synthetic KO from the stub server (with latency)
+#    and count the targets
+# -> saves the results as .json (best time of several repeats) and compares them with
+#    the results of an earlier run (e.g. of the previous version)
+
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+from contextlib import redirect_stdout
+
+BenchmarkFolder = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BenchmarkFolder))
+import Download_KEGG as KEGG
+import Import_Export as IE
+import Filter_Targets as FT
+import Run_Metrics as Metrics
+import VicinityAnalyzer as VA
+
+import Synthetic_Data as SD
+from Stub_KEGG import StubServer
+
+# Format of the result files (increase if the benchmarks are no longer comparable)
+Version = 1
+
+Targets = {"KO-ID": [SD.TargetKO], "Name": ["protein"], "Domain": ["SusD", "TonB"]}
+
+
+##-------------------------------------------------------------------------------------------------
+## BENCHMARK FUNCTIONS ----------------------------------------------------------------------------
+##-------------------------------------------------------------------------------------------------
+## ================================================================================================
+## Run the function several times (Setup before each run is not timed) -> best time in seconds
+def TimeFunction(Function, Repeats, Setup=None):
+	Best = None
+	for i in range(Repeats):
+		with redirect_stdout(io.StringIO()):
+			Arguments = Setup() if Setup is not None else ()
+			Start = time.perf_counter()
+			Function(*Arguments)
+			Duration = time.perf_counter() - Start
+		if Best is None or Duration < Best:
+			Best = Duration
+	return(Best)
+
+## ================================================================================================
+def Result(Seconds, Items, Unit, **Details):
+	return(dict({"Seconds": round(Seconds, 6), "Items": Items, "Unit": Unit,
+		"Rate": round(Items / Seconds, 1) if Seconds else None}, **Details))
+
+
+##-------------------------------------------------------------------------------------------------
+## MICRO BENCHMARKS -------------------------------------------------------------------------------
+##-------------------------------------------------------------------------------------------------
+## ================================================================================================
+## Neighbor IDs by locus tag increment and by gene order (Calls genes, range 5)
+def BenchmarkNeighbors(Calls, Repeats):
+	Genes = [SD.GetGeneID("yaaa", 20 + Index % 3900) for Index in range(Calls)]
+	Results = {"GetNeighborIndices": Result(TimeFunction(lambda: [KEGG.GetNeighborIndices(Gene,
+		5, 1) for Gene in Genes], Repeats), Calls, "genes")}
+	Text = KEGG.ParseGeneOrder(SD.FormatGeneList("yaaa"))
+	Results["BuildGeneOrder"] = Result(TimeFunction(lambda: KEGG.BuildGeneOrder(Text), Repeats),
+		SD.GenesPerOrganism, "genes")
+	Order = KEGG.BuildGeneOrder(Text)
+	Results["GetOrderedNeighbors"] = Result(TimeFunction(lambda: [KEGG.GetOrderedNeighbors(Gene,
+		5, Order) for Gene in Genes], Repeats), Calls, "genes")
+	return(Results)
+
+## ================================================================================================
+## Parse flat file entries (fixtures and synthetic entries, all fields and without sequence)
+def BenchmarkParser(Entries, Repeats):
+	Texts = list(SD.LoadFixtureEntries().values())
+	Texts += [SD.FormatEntry(SD.GetGeneID("yaaa", 1 + Index % SD.GenesPerOrganism))
+		for Index in range(max(0, Entries - len(Texts)))]
+	Data = "".join(Texts[:Entries])
+	Parse = lambda Fields: [KEGG.GetDetailedData(Entry, None, None, Fields)
+		for Entry in KEGG.IterEntries(io.StringIO(Data))]
+	NoSequence = tuple(Field for Field in KEGG.AllFields if Field != "Sequence")
+	return({"GetDetailedData": Result(TimeFunction(lambda: Parse(None), Repeats), Entries,
+			"entries"),
+		"GetDetailedData without sequence": Result(TimeFunction(lambda: Parse(NoSequence),
+			Repeats), Entries, "entries")})
+
+## ================================================================================================
+## Match and count the targets, export and combine fragments of a neighbor table
+def BenchmarkTables(Rows, FileType, Repeats, Folder):
+	Size = f"{Rows // 1000}k"
+	Data = SD.GenerateNeighbors(Rows)
+	Results = {}
+	Results[f"MatchTargets {Size}"] = Result(TimeFunction(lambda: FT.MatchTargets(Data, Targets),
+		Repeats), Rows, "rows")
+	Matrix = FT.MatchTargets(Data, Targets)
+	Results[f"CountTargets {Size}"] = Result(TimeFunction(lambda: FT.CountTargets(Data, Matrix),
+		Repeats), Rows, "rows")
+
+	# Fragments of 25 reference genes, as saved by GetNeighbors
+	FragmentRows = 25 * 10
+	FragmentList = []
+	for Index, Start in enumerate(range(0, Rows, FragmentRows)):
+		FragmentFile = os.path.join(Folder, f"Fragment_{Index+1}")
+		with redirect_stdout(io.StringIO()):
+			IE.ExportDataFrame(Data.iloc[Start:Start+FragmentRows], FragmentFile,
+				FileType=FileType, Ask=False)
+		FragmentList.append(FragmentFile + FileType)
+	OutputPath = os.path.join(Folder, "Neighbors")
+	Results[f"ExportDataFrame {Size} {FileType}"] = Result(TimeFunction(lambda:
+		IE.ExportDataFrame(Data, OutputPath, FileType=FileType, Ask=False), Repeats), Rows, "rows")
+	Results[f"CombineFiles {Size} {FileType}"] = Result(TimeFunction(lambda:
+		IE.CombineFiles(FragmentList, OutputPath, ";", FileType, False), Repeats), Rows, "rows",
+		Fragments=len(FragmentList))
+
+	# Each repeat counts all targets (the counts of the repeat before are not reused)
+	def ClearCounts():
+		if os.path.exists(OutputPath + "_CountInfo.json"):
+			os.remove(OutputPath + "_CountInfo.json")
+		return(())
+	Results[f"CountNeighbors {Size} {FileType}"] = Result(TimeFunction(lambda:
+		VA.CountNeighbors(OutputPath, Targets, FileType, ";", False), Repeats, ClearCounts),
+		Rows, "rows")
+	Results[f"CountNeighbors fragments {Size} {FileType} p2"] = Result(TimeFunction(lambda:
+		VA.CountNeighbors(OutputPath, Targets, FileType, ";", False, 2, FragmentList), Repeats,
+		ClearCounts), Rows, "rows", Fragments=len(FragmentList))
+	return(Results)
+
+
+##-------------------------------------------------------------------------------------------------
+## END-TO-END BENCHMARK ---------------------------------------------------------------------------
+##-------------------------------------------------------------------------------------------------
+## ================================================================================================
+## Download the neighbors of a synthetic KO from the stub server and count the targets
+## -> each repeat starts without cache and without files
+def BenchmarkRun(Genes, Latency, Workers, NeighborMode, FileType, Repeats, Folder):
+	Server = StubServer(Latency).Start()
+	Name = f"Run {Genes} genes {NeighborMode} w{Workers} {FileType}"
+	try:
+		Analyzer = VA.VicinityAnalyzer(FileType=FileType, Workers=Workers, RequestRate=0,
+			KeggURL=Server.URL, Retries=0, NeighborMode=NeighborMode, UseCache=False)
+		KO = f"K{Genes:05d}"
+
+		def Setup():
+			shutil.rmtree(os.path.join(Folder, "Run"), ignore_errors=True)
+			FragmentFolder = IE.CreateFolder(os.path.join(Folder, "Run", "Fragments"))
+			Analyzer.Session.GeneOrders.clear()
+			Analyzer.Session.Taxonomy = None
+			Metrics.Reset()
+			return((os.path.join(FragmentFolder, "Neighbors"), os.path.join(Folder, "Run",
+				"Neighbors")))
+
+		def Run(FragmentFile, OutputPath):
+			IDList = Analyzer.RetrieveIDs(KO)
+			Analyzer.GetNeighbors(IDList, FragmentFile, OutputPath)
+			Analyzer.CountNeighbors(OutputPath, Targets)
+
+		Requests = Server.GetRequests()
+		Seconds = TimeFunction(Run, Repeats, Setup)
+		Requests = (Server.GetRequests() - Requests) // Repeats
+		Analyzer.Close()
+	finally:
+		Server.Stop()
+	return({Name: Result(Seconds, Genes, "genes", Requests=Requests, Latency=Latency)})
+
+
+##-------------------------------------------------------------------------------------------------
+## RESULT FUNCTIONS -------------------------------------------------------------------------------
+##-------------------------------------------------------------------------------------------------
+## ================================================================================================
+def GetCommit():
+	try:
+		return(subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+			text=True, cwd=BenchmarkFolder).stdout.strip() or None)
+	except OSError:
+		return(None)
+
+## ================================================================================================
+## Print the results (and the change compared to earlier results)
+## -> returns the names of the benchmarks that are slower by more than Threshold (e.g. 0.1=10%)
+def PrintResults(Results, Previous=None, Threshold=0.1):
+	Slower = []
+	print(f"\n{'Benchmark':<45}{'Seconds':>10}{'Rate':>14}  {'Change':>8}")
+	for Name, Values in Results.items():
+		Line = f"{Name:<45}{Values['Seconds']:>10.4f}{Values['Rate'] or 0:>10.0f}/{Values['Unit'][0]:<3}"
+		if Previous is not None and Name in Previous["Results"]:
+			Change = Values["Seconds"] / Previous["Results"][Name]["Seconds"] - 1
+			Line += f"  {Change:>+8.1%}"
+			if Change > Threshold:
+				Line += "  SLOWER"
+				Slower.append(Name)
+		print(Line)
+	return(Slower)
+
+
+##-------------------------------------------------------------------------------------------------
+## SCRIPT -----------------------------------------------------------------------------------------
+##-------------------------------------------------------------------------------------------------
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Offline benchmarks of the Vicinity Analyzer "
+		"(components and complete runs with a local KEGG stub server)")
+	parser.add_argument("-b", "--benchmarks",
+		help="benchmarks to run: n=neighbor indices, p=parser, t=tables (match, count, export, "
+		"combine), e=end-to-end (default: %(default)s)",
+		default="npte")
+	parser.add_argument("-rows", "--rows",
+		help="rows of the synthetic neighbor tables, comma-separated (default: %(default)s)",
+		default="10000,100000")
+	parser.add_argument("-g", "--genes",
+		help="genes of the synthetic KO downloaded end-to-end (default: %(default)s)",
+		default=200,
+		type=int)
+	parser.add_argument("-l", "--latency",
+		help="seconds the stub server waits before each response (default: %(default)s)",
+		default=0.02,
+		type=float)
+	parser.add_argument("-w", "--workers",
+		help="workers of the end-to-end benchmark, comma-separated (default: %(default)s)",
+		default="1,4")
+	parser.add_argument("-nm", "--neighbormode",
+		help="neighbor modes of the end-to-end benchmark, comma-separated (default: %(default)s)",
+		default="order,locus")
+	parser.add_argument("-ft", "--filetype",
+		help="file types of the table and end-to-end benchmarks, comma-separated "
+		"(default: %(default)s)",
+		default=".csv")
+	parser.add_argument("-r", "--repeats",
+		help="number of repeats, the best time is reported (default: %(default)s)",
+		default=3,
+		type=int)
+	parser.add_argument("-o", "--output",
+		help="file of the results (default: Benchmark/Results/Benchmark_<date>_<commit>.json)")
+	parser.add_argument("-c", "--compare",
+		help="results of an earlier run (.json) to compare with")
+	parser.add_argument("-t", "--threshold",
+		help="slowdown reported as regression, e.g. 0.1 = 10%% slower (default: %(default)s)",
+		default=0.1,
+		type=float)
+	args = parser.parse_args()
+
+	FileTypes = args.filetype.split(",")
+	Results = {}
+	Folder = tempfile.mkdtemp(prefix="VicinityBenchmark_")
+	try:
+		if "n" in args.benchmarks:
+			Results.update(BenchmarkNeighbors(100000, args.repeats))
+		if "p" in args.benchmarks:
+			Results.update(BenchmarkParser(5000, args.repeats))
+		if "t" in args.benchmarks:
+			for Rows in args.rows.split(","):
+				for FileType in FileTypes:
+					Results.update(BenchmarkTables(int(Rows), FileType, args.repeats, Folder))
+		if "e" in args.benchmarks:
+			for NeighborMode in args.neighbormode.split(","):
+				for Workers in args.workers.split(","):
+					Results.update(BenchmarkRun(args.genes, args.latency, int(Workers),
+						NeighborMode, FileTypes[0], args.repeats, Folder))
+	finally:
+		shutil.rmtree(Folder, ignore_errors=True)
+
+	Commit = GetCommit()
+	Report = {"Version": Version, "Date": time.strftime("%Y-%m-%d %H:%M:%S"), "Commit": Commit,
+		"Python": platform.python_version(), "Machine": platform.platform(),
+		"Processors": os.cpu_count(), "Settings": vars(args), "Results": Results}
+	Previous = None
+	if args.compare:
+		with open(args.compare) as File:
+			Previous = json.load(File)
+		if Previous.get("Version") != Version:
+			print(f"Warning: {args.compare} has another format (version {Previous.get('Version')})")
+		print(f"Compared with {args.compare} (commit {Previous.get('Commit')}, {Previous.get('Date')})")
+	Slower = PrintResults(Results, Previous, args.threshold)
+
+	if args.output is None:
+		args.output = os.path.join(BenchmarkFolder, "Results",
+			f"Benchmark_{time.strftime('%Y%m%d_%H%M%S')}_{Commit or 'local'}.json")
+	if os.path.dirname(args.output):
+		os.makedirs(os.path.dirname(args.output), exist_ok=True)
+	with open(args.output, "w") as File:
+		json.dump(Report, File, indent=2)
+	print(f"\nResults saved as: {args.output}")
+	if Slower:
+		print(f"{len(Slower)} benchmarks are more than {args.threshold:.0%} slower")
+		sys.exit(1)
@@ -0,0 +1,119 @@
+#!/usr/bin/python
+# Written in Python 3.8 in 2023 by A.L.O. Gaenssle
+
+# BENCHMARK MODULE: LOCAL KEGG STUB SERVER
+# -> answers get, list and find requests like rest.kegg.jp (HTTP/1.1 keep-alive, gzip)
+# -> serves synthetic data only (no recorded KEGG responses): the entries of the fixtures and
+#    generated genes (Synthetic_Data: synthetic KO IDs find their genes, e.g. find/genes/K90000
+#    with 90000 genes)
+# -> waits the given latency before each response (to simulate the network)
+# -> can run in the background of a benchmark (StubServer) or on its own (python Stub_KEGG.py)
+
+import re
+import sys
+import gzip
+import time
+import argparse
+import threading
+import http.server
+
+import Synthetic_Data as SD
+
+
+##-------------------------------------------------------------------------------------------------
+## SERVER -----------------------------------------------------------------------------------------
+##-------------------------------------------------------------------------------------------------
+## ================================================================================================
+## Answer a request like the KEGG REST API (404 if nothing was found)
+class StubHandler(http.server.BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1"
+
+	def do_GET(self):
+		Server = self.server
+		time.sleep(Server.Latency)
+		with Server.Lock:
+			Server.Requests += 1
+		Parts = self.path.strip("/").split("/", 1)
+		Operation, Argument = (Parts + [""])[:2]
+		Body = ""
+		if Operation == "get":
+			for GeneID in Argument.split("+"):
+				Entry = Server.Fixtures.get(GeneID)
+				if Entry is None and ":" in GeneID:
+					Entry = SD.FormatEntry(GeneID)
+				if Entry is not None:
+					Body += Entry
+		elif Operation == "list" and Argument == "organism":
+			Body = SD.FormatOrganismList(Server.Organisms)
+		elif Operation == "list":
+			Body = SD.FormatGeneList(Argument)
+		elif Operation == "find":
+			Match = re.match(r"^genes/K(\d+)$", Argument)
+			if Match:
+				Body = SD.FormatFind(SD.GetKOGenes(int(Match.group(1))))
+		Data = Body.encode("utf-8")
+		Compress = Data and "gzip" in self.headers.get("Accept-Encoding", "")
+		if Compress:
+			Data = gzip.compress(Data, compresslevel=1)
+		self.send_response(200 if Data else 404)
+		if Compress:
+			self.send_header("Content-Encoding", "gzip")
+		self.send_header("Content-Length", str(len(Data)))
+		self.end_headers()
+		self.wfile.write(Data)
+
+	def log_message(self, *Args):
+		pass
+
+## ================================================================================================
+## Stub server running in a background thread (URL to be used as KEGG address)
+## -> Organisms: number of synthetic organisms in list/organism
+class StubServer:
+	def __init__(self, Latency=0.0, Port=0, Organisms=5000):
+		self.Server = http.server.ThreadingHTTPServer(("127.0.0.1", Port), StubHandler)
+		self.Server.daemon_threads = True
+		self.Server.Latency = Latency
+		self.Server.Lock = threading.Lock()
+		self.Server.Requests = 0
+		self.Server.Fixtures = SD.LoadFixtureEntries()
+		self.Server.Organisms = sorted(set(GeneID.split(":")[0] 
+			for GeneID in self.Server.Fixtures)) + SD.GetOrganisms(Organisms)
+		self.URL = f"http://127.0.0.1:{self.Server.server_address[1]}"
+		self.Thread = None
+
+	def Start(self):
+		self.Thread = threading.Thread(target=self.Server.serve_forever, daemon=True)
+		self.Thread.start()
+		return(self)
+
+	def Stop(self):
+		self.Server.shutdown()
+		self.Server.server_close()
+
+	def GetRequests(self):
+		return(self.Server.Requests)
+
+
+##-------------------------------------------------------------------------------------------------
+## SCRIPT -----------------------------------------------------------------------------------------
+##-------------------------------------------------------------------------------------------------
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Local KEGG stub server for benchmarks "
+		"(use with Main.py -url http://127.0.0.1:PORT)")
+	parser.add_argument("-p", "--port",
+		help="port of the server (default: %(default)s)",
+		default=8765,
+		type=int)
+	parser.add_argument("-l", "--latency",
+		help="seconds waited before each response (default: %(default)s)",
+		default=0.05,
+		type=float)
+	args = parser.parse_args()
+
+	Server = StubServer(args.latency, args.port)
+	print(f"KEGG stub server running at {Server.URL} (latency {args.latency} s), stop with Ctrl+C")
+	try:
+		Server.Server.serve_forever()
+	except KeyboardInterrupt:
+		Server.Stop()
+		sys.exit(0)
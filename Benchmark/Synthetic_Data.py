@@ -0,0 +1,152 @@
+#!/usr/bin/python
+# Written in Python 3.8 in 2023 by A.L.O. Gaenssle
+
+# BENCHMARK MODULE: SYNTHETIC KEGG DATA
+# -> generates organisms, gene lists and flat-file entries of a KO with any number of genes
+# -> generates neighbor tables with any number of rows (e.g. 10k to 1M) as saved by the program
+# -> the same arguments always return the same data
+
+import os
+import random
+import numpy as np
+import pandas as pd
+
+FixtureFolder = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Fixtures")
+
+Lineages = [("Prokaryotes", "Bacteria", "Bacteroidota", "Bacteroidia"),
+	("Prokaryotes", "Bacteria", "Pseudomonadota", "Gammaproteobacteria"),
+	("Prokaryotes", "Bacteria", "Bacillota", "Bacilli"),
+	("Prokaryotes", "Bacteria", "Actinomycetota", "Actinomycetes"),
+	("Prokaryotes", "Archaea", "Euryarchaeota", "Methanomicrobia")]
+Domains = ["SusD-like_3 SusD_RagB", "SusC TonB_dep_Rec", "Glyco_hydro_16", "ABC_tran",
+	"Response_reg HisKA", "Sigma70_r2 Sigma70_r4_2", "Lipoprotein_9"]
+AminoAcids = "ACDEFGHIKLMNPQRSTVWY"
+TargetKO = "K21572"
+
+# Genes of each synthetic genome (the reference genes are spread over the genome)
+GenesPerOrganism = 4000
+
+
+##-------------------------------------------------------------------------------------------------
+## KEGG RESPONSES ---------------------------------------------------------------------------------
+##-------------------------------------------------------------------------------------------------
+## ================================================================================================
+## Get the orgIDs of a number of synthetic organisms (e.g. "yaab", "yaac", ...)
+def GetOrganisms(Count):
+	Letters = "abcdefghijklmnopqrstuvwxyz"
+	return(["y" + Letters[Index // 676 % 26] + Letters[Index // 26 % 26] + Letters[Index % 26]
+		for Index in range(Count)])
+
+## ================================================================================================
+def GetGeneID(orgID, Index):
+	return(f"{orgID}:{orgID.upper()}_{Index:05d}")
+
+## ================================================================================================
+## Get the gene IDs of a synthetic KO (spread over the organisms and their genomes)
+def GetKOGenes(Genes, Organisms=None):
+	if Organisms is None:
+		Organisms = max(1, Genes // 25)
+	orgIDs = GetOrganisms(Organisms)
+	Spacing = max(1, (GenesPerOrganism - 40) // -(-Genes // Organisms))
+	return([GetGeneID(orgIDs[Index % Organisms], 20 + Index // Organisms * Spacing)
+		for Index in range(Genes)])
+
+## ================================================================================================
+## KEGG find genes/<KO> -> gene ID and description per line
+def FormatFind(GeneIDs):
+	return("".join(f"{GeneID}\tstarch-binding protein, SusD/RagB family\n" for GeneID in GeneIDs))
+
+## ================================================================================================
+## KEGG list organism -> T number, orgID, name and lineage (separated by ;) per line
+def FormatOrganismList(orgIDs):
+	return("".join(f"T{Index+90000:05d}\t{orgID}\tSyntheticus {orgID}\t"
+		+ ";".join(Lineages[Index % len(Lineages)]) + "\n"
+		for Index, orgID in enumerate(orgIDs)))
+
+## ================================================================================================
+## KEGG list <orgID> -> gene ID, type, position and name per line (order of the genome)
+def FormatGeneList(orgID):
+	return("".join(f"{GetGeneID(orgID, Index)}\tCDS\t{Index*1100}..{Index*1100+950}\tgene{Index}\n"
+		for Index in range(1, GenesPerOrganism + 1)))
+
+## ================================================================================================
+## KEGG get -> flat file entry of a synthetic gene (None if the gene does not exist)
+def FormatEntry(GeneID):
+	orgID, Tag = GeneID.split(":", 1)
+	Number = Tag.rsplit("_", 1)[-1]
+	if not Number.isdigit() or not 1 <= int(Number) <= GenesPerOrganism:
+		return(None)
+	Index = int(Number)
+	Random = random.Random(GeneID)
+	Length = Random.randint(120, 900)
+	Sequence = "".join(Random.choice(AminoAcids) for i in range(Length))
+	KO = TargetKO if Index % 20 == 0 else f"K{Random.randint(1, 25000):05d}"
+	return(f"ENTRY       {Tag:<18}CDS       T90000\n"
+		f"NAME        (GenBank) protein {Tag}\n"
+		f"ORTHOLOGY   {KO}  synthetic protein\n"
+		f"ORGANISM    {orgID}  Syntheticus {orgID}\n"
+		f"POSITION    {Index*1100}..{Index*1100+950}\n"
+		f"MOTIF       Pfam: {Domains[Index % len(Domains)]}\n"
+		f"DBLINKS     NCBI-ProteinID: WP_{Index:09d}\n"
+		f"            UniProt: A0A{Random.randint(0, 999999):06d}\n"
+		f"AASEQ       {Length}\n"
+		+ "".join(f"            {Sequence[x:x+60]}\n" for x in range(0, Length, 60))
+		+ f"NTSEQ       {Length*3+3}\n"
+		+ "///\n")
+
+## ================================================================================================
+## Load the synthetic KEGG-get entries of the fixtures -> dict of gene ID: entry
+def LoadFixtureEntries():
+	Entries = {}
+	for File in sorted(os.listdir(FixtureFolder)):
+		if File.startswith("Synthetic_KEGG_Get_"):
+			with open(os.path.join(FixtureFolder, File)) as Fixture:
+				for Entry in Fixture.read().split("///\n"):
+					if not Entry.strip():
+						continue
+					Tag = Entry.split()[1]
+					orgID = Entry.split("\nORGANISM", 1)[1].split()[0]
+					Entries[orgID + ":" + Tag] = Entry + "///\n"
+	return(Entries)
+
+
+##-------------------------------------------------------------------------------------------------
+## NEIGHBOR TABLES --------------------------------------------------------------------------------
+##-------------------------------------------------------------------------------------------------
+## ================================================================================================
+## Generate a table of neighbors (as in <name>_Neighbors) with the given number of rows
+## -> Range neighbors on each side of every reference gene (Rows/(2*Range) reference genes)
+def GenerateNeighbors(Rows, Range=5, Sequences=True, Seed=1):
+	Generator = np.random.default_rng(Seed)
+	Positions = np.array([Pos for Pos in range(-Range, Range + 1) if Pos != 0])
+	References = -(-Rows // len(Positions))
+	Organisms = max(1, References // 25)
+	orgIDs = np.array(GetOrganisms(Organisms))
+	RefIndex = np.repeat(np.arange(References), len(Positions))[:Rows]
+	Pos = np.tile(Positions, References)[:Rows]
+	orgID = orgIDs[RefIndex % Organisms]
+	Spacing = max(1, (GenesPerOrganism - 40) // -(-References // Organisms))
+	RefNumber = 20 + RefIndex // Organisms * Spacing
+	Prefix = pd.Series(orgID) + ":" + pd.Series(np.char.upper(orgID)) + "_"
+	Data = pd.DataFrame({
+		"Ref": Prefix + pd.Series(RefNumber).astype(str).str.zfill(5),
+		"ID": Prefix + pd.Series(RefNumber + Pos).astype(str).str.zfill(5),
+		"orgID": orgID})
+	Lengths = Generator.integers(120, 900, Rows)
+	if Sequences:
+		Letters = np.frombuffer(AminoAcids.encode(), dtype="S1")
+		Pool = b"".join(Generator.choice(Letters, 4000)).decode()
+		Starts = Generator.integers(0, 4000 - 900, Rows)
+		Data["Sequence"] = [Pool[Start:Start+Length] for Start, Length in zip(Starts, Lengths)]
+	Data["Name"] = "protein " + Data["ID"].str.split(":").str[1]
+	KO = pd.Series(Generator.integers(1, 25000, Rows)).astype(str).str.zfill(5)
+	Data["KO-ID"] = ("K" + KO).where(Generator.random(Rows) > 0.05, TargetKO)
+	Data["Organism"] = "Syntheticus " + Data["orgID"]
+	Data["Domain"] = np.array(Domains)[Generator.integers(0, len(Domains), Rows)]
+	Data["UniProt"] = "A0A" + pd.Series(Generator.integers(0, 999999, Rows)).astype(str).str.zfill(6)
+	Data["Length"] = Lengths
+	Data["Pos"] = Pos
+	Data["Status"] = "Complete"
+	Taxonomy = np.array(["-".join(Lineage[:2]) for Lineage in Lineages])
+	Data["Taxonomy"] = Taxonomy[RefIndex % Organisms % len(Lineages)]
+	return(Data)
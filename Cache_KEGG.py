@@ -0,0 +1,123 @@
+#!/usr/bin/python
+# Written in Python 3.8 in 2023 by A.L.O. Gaenssle
+
+# MODULE: CACHE KEGG ENTRIES
+# -> stores the raw KEGG entries (gene flat files and lists) by their ID in a local SQLite file
+# -> entries expire after the set number of days or if the cache version changes
+# -> the least recently used entries are removed if the cache exceeds its size limit
+# -> in offline mode, only cached entries are returned and nothing is downloaded
+
+import os
+import time
+import sqlite3
+import threading
+
+# Increase to invalidate all entries cached by older versions (e.g. if the parser changes)
+Version = 1
+
+# Cache shared by all runs of the user
+DefaultFile = os.path.join(os.path.expanduser("~"), ".VicinityAnalyzer", "KEGG_Cache.sqlite")
+
+
+##-------------------------------------------------------------------------------------------------
+## CACHE CLASS ------------------------------------------------------------------------------------
+##-------------------------------------------------------------------------------------------------
+## ================================================================================================
+## Raised in offline mode if a required entry is not in the cache
+class OfflineError(LookupError):
+	pass
+
+## ================================================================================================
+## Local cache of KEGG entries (MaxAge in days, MaxSize in MB)
+## -> entries that do not exist on KEGG are saved as None, so that they are not requested again
+class EntryCache:
+	def __init__(self, FilePath, MaxAge=30, MaxSize=2048, Offline=False):
+		Folder = os.path.dirname(FilePath)
+		if Folder and not os.path.exists(Folder):
+			os.makedirs(Folder)
+		self.FilePath = FilePath
+		self.MaxAge = MaxAge * 86400
+		self.MaxSize = MaxSize * 1024 * 1024
+		self.Offline = Offline
+		self.Lock = threading.Lock()
+		self.Connection = sqlite3.connect(FilePath, check_same_thread=False)
+		self.Connection.execute("PRAGMA journal_mode=WAL")
+		self.Connection.execute("PRAGMA synchronous=NORMAL")
+		self.Connection.execute("CREATE TABLE IF NOT EXISTS Entries (Key TEXT PRIMARY KEY, "
+			"Entry TEXT, Size INTEGER, Version INTEGER, Created REAL, Accessed REAL)")
+		self.Connection.execute("CREATE INDEX IF NOT EXISTS AccessedIndex ON Entries (Accessed)")
+		self.Connection.commit()
+		self.Size = self.Connection.execute("SELECT COALESCE(SUM(Size), 0) FROM Entries").fetchone()[0]
+
+	## --------------------------------------------------------------------------------------------
+	## Get all valid cached entries -> returns dict of Key:Entry (keys not in cache are missing)
+	## -> expired entries are still returned in offline mode
+	def Get(self, Keys):
+		Found = {}
+		Now = time.time()
+		with self.Lock:
+			for x in range(0, len(Keys), 500):
+				Chunk = list(Keys[x:x+500])
+				Query = ("SELECT Key, Entry, Version, Created FROM Entries WHERE Key IN ("
+					+ ",".join("?"*len(Chunk)) + ")")
+				for Key, Entry, EntryVersion, Created in self.Connection.execute(Query, Chunk):
+					if EntryVersion != Version:
+						continue
+					if not self.Offline and Now - Created > self.MaxAge:
+						continue
+					Found[Key] = Entry
+			if Found:
+				self.Connection.executemany("UPDATE Entries SET Accessed=? WHERE Key=?",
+					[(Now, Key) for Key in Found])
+				self.Connection.commit()
+		return(Found)
+
+	## --------------------------------------------------------------------------------------------
+	## Add or replace entries (dict of Key:Entry) and remove old entries if the cache is too large
+	def Put(self, Entries):
+		if not Entries:
+			return
+		Now = time.time()
+		Rows = []
+		for Key, Entry in Entries.items():
+			Size = len(Key) + (len(Entry) if Entry is not None else 0)
+			Rows.append((Key, Entry, Size, Version, Now, Now))
+		with self.Lock:
+			Old = 0
+			for x in range(0, len(Rows), 500):
+				Chunk = [Row[0] for Row in Rows[x:x+500]]
+				Query = ("SELECT COALESCE(SUM(Size), 0) FROM Entries WHERE Key IN ("
+					+ ",".join("?"*len(Chunk)) + ")")
+				Old += self.Connection.execute(Query, Chunk).fetchone()[0]
+			self.Connection.executemany("INSERT OR REPLACE INTO Entries VALUES (?,?,?,?,?,?)", Rows)
+			self.Connection.commit()
+			self.Size += sum(Row[2] for Row in Rows) - Old
+			if self.Size > self.MaxSize:
+				self.Evict()
+
+	## --------------------------------------------------------------------------------------------
+	## Remove the least recently used entries until the cache is below 90% of its size limit
+	def Evict(self):
+		Target = self.MaxSize * 0.9
+		Removed = 0
+		while self.Size > Target:
+			Rows = self.Connection.execute("SELECT Key, Size FROM Entries "
+				"ORDER BY Accessed LIMIT 1000").fetchall()
+			if not Rows:
+				self.Size = 0
+				break
+			Delete = []
+			for Key, Size in Rows:
+				Delete.append((Key,))
+				self.Size -= Size
+				if self.Size <= Target:
+					break
+			self.Connection.executemany("DELETE FROM Entries WHERE Key=?", Delete)
+			Removed += len(Delete)
+		self.Connection.commit()
+		print(f"Removed {Removed} old entries from the cache {self.FilePath}")
+
+	## --------------------------------------------------------------------------------------------
+	def Close(self):
+		with self.Lock:
+			self.Connection.close()
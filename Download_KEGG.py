@@ -3,17 +3,274 @@
 
 # MODULE: DOWNLOAD PROTEIN DATA from KEGG
 # -> downloads information of protein entries by ID in chunks
-# -> downloads all organism ids available on KEGG and their taxonomic classification
+# -> downloads all organism ids available on KEGG and their lineage (kept in Taxonomy_KEGG index)
 # -> downloads all neighbors within the given range of each given protein ID
+# -> downloads clusters of genes concurrently with a shared request rate limit
+# -> reuses entries from a local cache (Cache_KEGG) and only downloads missing IDs
+# -> finds neighbors by their position in the genome (gene order) or by locus tag increments
+# -> keeps persistent connections in a pool shared by all threads (gzip, retries with backoff on 
+#    403/429/5xx)
+# -> the connection, cache and taxonomy settings are kept per analysis (KeggSession)
+# -> each downloaded protein is kept once and shared by all genes it neighbors (Neighbor)
 
 import pandas as pd
-from io import StringIO
+import io
 import re
-import Bio
-from Bio.KEGG import REST
-import urllib.request
+import sys
+import time
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import gzip
+import random
+import http.client
+import urllib.parse
+from collections import OrderedDict
+from functools import lru_cache
 import ssl
-ssl._create_default_https_context = ssl._create_unverified_context
+
+# Own modules
+import Run_Metrics as Metrics
+import Cache_KEGG
+import Taxonomy_KEGG
+
+# Number of organisms of which the gene order is kept in memory (per session)
+MaxGeneOrders = 64
+
+# Chromosome (optional) and start of the gene position in KEGG lists, e.g. "2:complement(10..90)"
+PositionPattern = re.compile(r"^(?:([^:(]+):)?\D*?(\d+)")
+
+
+##-------------------------------------------------------------------------------------------------
+## REQUEST FUNCTIONS ------------------------------------------------------------------------------
+##-------------------------------------------------------------------------------------------------
+## ================================================================================================
+## Limit the number of requests per second over all threads (KEGG allows ~3 requests/second)
+class RateLimiter:
+	def __init__(self, RequestsPerSecond=3):
+		self.Lock = threading.Lock()
+		self.Next = 0.0
+		self.SetRate(RequestsPerSecond)
+
+	def SetRate(self, RequestsPerSecond):
+		if RequestsPerSecond and RequestsPerSecond > 0:
+			self.Interval = 1.0 / RequestsPerSecond
+		else:
+			self.Interval = 0.0
+
+	# Reserve the next free time slot and sleep (outside of the lock) until it is reached
+	def Wait(self):
+		with self.Lock:
+			Now = time.monotonic()
+			Slot = max(Now, self.Next)
+			self.Next = Slot + self.Interval
+		if Slot > Now:
+			time.sleep(Slot - Now)
+
+## ================================================================================================
+## Error response of KEGG (e.g. Status=404 if none of the requested IDs exist)
+class KeggError(Exception):
+	def __init__(self, Status, URL):
+		super().__init__(f"KEGG returned HTTP {Status} for {URL}")
+		self.Status = Status
+		self.URL = URL
+
+## Errors of a failed request (KEGG error or broken connection)
+RequestErrors = (KeggError, http.client.HTTPException, OSError)
+
+## ================================================================================================
+## Persistent connections to the KEGG API (kept in a pool that is shared by all threads)
+## -> each request takes a connection from the pool (opened if none is free), it is returned to the
+##    pool once the response has been read completely (Release) or closed if it broke (Close)
+## -> all connections are closed with CloseAll (e.g. at the end of the program)
+## -> the requests of all threads are limited to RequestsPerSecond (0 or None for no limit)
+## -> responses are requested gzip-compressed
+## -> 403, 429 and 5xx responses and broken connections are retried after an exponential 
+##    backoff with random jitter (Backoff * 2^attempt seconds at most), other errors are raised
+class KeggTransport:
+	RetryStatus = {403, 429, 500, 502, 503, 504}
+
+	def __init__(self, URL="https://rest.kegg.jp", Retries=4, Backoff=1.0, Timeout=60, 
+		Verify=True, RequestsPerSecond=3):
+		Address = urllib.parse.urlsplit(URL.rstrip("/"))
+		self.URL = URL.rstrip("/")
+		self.Secure = Address.scheme == "https"
+		self.Host = Address.netloc
+		self.Path = Address.path
+		self.Retries = Retries
+		self.Backoff = Backoff
+		self.Timeout = Timeout
+		if Verify:
+			self.Context = ssl.create_default_context()
+		else:
+			self.Context = ssl._create_unverified_context()
+		self.Limiter = RateLimiter(RequestsPerSecond)
+		self.Idle = queue.LifoQueue()
+		self.Lock = threading.Lock()
+		self.Connections = set()
+		self.Local = threading.local()
+
+	# Get the connection taken by this thread (from the pool or a new one)
+	def Connect(self):
+		Connection = getattr(self.Local, "Connection", None)
+		if Connection is None:
+			try:
+				Connection = self.Idle.get_nowait()
+			except queue.Empty:
+				if self.Secure:
+					Connection = http.client.HTTPSConnection(self.Host, timeout=self.Timeout, 
+						context=self.Context)
+				else:
+					Connection = http.client.HTTPConnection(self.Host, timeout=self.Timeout)
+				with self.Lock:
+					self.Connections.add(Connection)
+				Metrics.Count("Connections opened")
+			self.Local.Connection = Connection
+		return(Connection)
+
+	# Return the connection of this thread to the pool (the response has been read completely)
+	def Release(self):
+		Connection = getattr(self.Local, "Connection", None)
+		if Connection is not None:
+			self.Local.Connection = None
+			self.Idle.put(Connection)
+
+	# Close the connection of this thread (e.g. if it broke or the response was not read)
+	def Close(self):
+		Connection = getattr(self.Local, "Connection", None)
+		if Connection is not None:
+			Connection.close()
+			self.Local.Connection = None
+			with self.Lock:
+				self.Connections.discard(Connection)
+
+	# Close all connections of the pool and of all threads
+	def CloseAll(self):
+		with self.Lock:
+			for Connection in self.Connections:
+				Connection.close()
+			self.Connections.clear()
+		while not self.Idle.empty():
+			self.Idle.get_nowait()
+
+	# Send a request (e.g. Operation="get", Argument="cak:Caul_3276") -> returns the response
+	# -> the response has to be read completely and Release called (or Close) afterwards
+	def Open(self, Operation, Argument):
+		Path = self.Path + "/" + Operation + "/" + urllib.parse.quote(Argument, safe=":+/")
+		for Attempt in range(self.Retries + 1):
+			with Metrics.Stage("Rate limit"):
+				self.Limiter.Wait()
+			Wait = random.uniform(0, self.Backoff * 2**Attempt)
+			Metrics.Count("Requests")
+			if Attempt:
+				Metrics.Count("Retries")
+			try:
+				with Metrics.Stage("Waiting for KEGG"):
+					Connection = self.Connect()
+					Connection.request("GET", Path, headers={"Accept-Encoding": "gzip"})
+					Response = Connection.getresponse()
+			except (http.client.HTTPException, OSError) as Error:
+				self.Close()
+				Metrics.Count("Connection errors")
+				Problem = Error
+			else:
+				if Response.status != 200:
+					Metrics.Count(f"HTTP {Response.status}")
+				if Response.status == 200:
+					Length = Response.getheader("Content-Length", "")
+					if Length.isdigit():
+						Metrics.Count("Bytes transferred", int(Length))
+					if Response.getheader("Content-Encoding") == "gzip":
+						return(gzip.GzipFile(fileobj=Response))
+					return(Response)
+				Response.read()
+				self.Release()
+				Problem = KeggError(Response.status, self.URL + Path)
+				if Response.status not in self.RetryStatus:
+					raise Problem
+				RetryAfter = Response.getheader("Retry-After", "")
+				if RetryAfter.isdigit():
+					Wait = max(Wait, int(RetryAfter))
+			if Attempt < self.Retries:
+				time.sleep(Wait)
+		raise Problem
+
+## ================================================================================================
+## Settings and state of the downloads of an analysis (e.g. of a VicinityAnalyzer)
+## -> Transport: connections to the KEGG API (KeggTransport, e.g. of a local mirror or test server)
+## -> Cache: local cache of KEGG entries (Cache_KEGG.EntryCache), None if disabled
+## -> TaxonomyFile: local file of the taxonomy index (None if not saved), which is downloaded 
+##    again after TaxonomyAge days
+## -> the taxonomy and the gene orders of the most recently used organisms are kept in memory
+## -> all download functions use the session given as last argument (DefaultSession if None)
+class KeggSession:
+	def __init__(self, Transport=None, Cache=None, TaxonomyFile=None, TaxonomyAge=30):
+		self.Transport = Transport if Transport is not None else KeggTransport()
+		self.Cache = Cache
+		self.TaxonomyFile = TaxonomyFile
+		self.TaxonomyAge = TaxonomyAge
+		self.Taxonomy = None
+		self.GeneOrders = OrderedDict()
+
+	# Close the connections and the cache
+	def Close(self):
+		self.Transport.CloseAll()
+		if self.Cache is not None:
+			self.Cache.Close()
+
+DefaultSession = KeggSession()
+
+## ================================================================================================
+## Send a single request to KEGG (e.g. Operation="get", Argument="cak:Caul_3276")
+def KeggRequest(Operation, Argument, Session=None):
+	Transport = (Session or DefaultSession).Transport
+	Response = Transport.Open(Operation, Argument)
+	try:
+		Download = Response.read()
+	except RequestErrors:
+		Transport.Close()
+		raise
+	Transport.Release()
+	Metrics.Count("Bytes received", len(Download))
+	return(Download.decode("utf-8"))
+
+## ================================================================================================
+## Send a single request to KEGG and read the response line by line while it is downloaded
+## -> the connection is returned to the pool, or closed if the response is not read completely
+def KeggStream(Operation, Argument, Session=None):
+	Transport = (Session or DefaultSession).Transport
+	Response = Transport.Open(Operation, Argument)
+	Complete = False
+	Received = 0
+	try:
+		for Line in io.TextIOWrapper(Response, encoding="utf-8"):
+			Received += len(Line)
+			yield(Line)
+		Complete = True
+	finally:
+		Metrics.Count("Bytes received", Received)
+		if Complete:
+			Transport.Release()
+		else:
+			Transport.Close()
+
+## ================================================================================================
+## Send a request to KEGG or return the cached result (e.g. organism list)
+def CachedRequest(Operation, Argument, Session=None):
+	Cache = (Session or DefaultSession).Cache
+	Key = Operation + "/" + Argument
+	if Cache is not None:
+		Found = Cache.Get([Key])
+		if Found.get(Key) is not None:
+			Metrics.Count("Cache hits")
+			return(Found[Key])
+		Metrics.Count("Cache misses")
+		if Cache.Offline:
+			raise Cache_KEGG.OfflineError(f"{Key} is not in the cache (offline mode)")
+	Download = KeggRequest(Operation, Argument, Session)
+	if Cache is not None:
+		Cache.Put({Key: Download})
+	return(Download)
 
 
 ##-------------------------------------------------------------------------------------------------
@@ -21,8 +278,8 @@ ssl._create_default_https_context = ssl._create_unverified_context
 ##-------------------------------------------------------------------------------------------------
 ## ================================================================================================
 ## Download all gene IDs associated with the supplied KEGG Orthology (KO)
-def DownloadOrthology(Input):
-	Download = REST.kegg_find("genes",Input).read()
+def DownloadOrthology(Input, Session=None):
+	Download = CachedRequest("find", "genes/" + Input, Session)
 	GeneList = Download.strip().split("\n")
 	ListOfList = [i.split("\t") for i in GeneList]
 	DataFrame = pd.DataFrame(ListOfList, columns=["ID", "Description"])
@@ -30,20 +287,134 @@ def DownloadOrthology(Input):
 
 
 ## ================================================================================================
-## Download all genome taxonomy from KEGG --> KEGG-list
-def DownloadOrganismsTemp(Name="organism"):
-	print("Download organism taxonomy. . .")
-	Entry = REST.kegg_list(Name).read()
-	Entry = Entry.replace(";" , "\t")
-	ColList = ["ID long", "orgID", "Organism", "Kingdom", "Phylum", "Class", "Order"]
-	DataFrame = pd.read_csv(StringIO(Entry), sep="\t", names=ColList)
-	DataFrame["Taxonomy"] = DataFrame["Kingdom"] + "-" + DataFrame["Phylum"]
-	DataFrame = DataFrame[["orgID","Taxonomy"]]
-	return(DataFrame)
+## Get the taxonomy index of all organisms on KEGG (loaded once per session) --> KEGG-list
+## -> the saved index is used if it is not older than TaxonomyAge days (or in offline mode)
+## -> a stale index is still used if the download fails
+def LoadTaxonomy(Session=None):
+	Session = Session or DefaultSession
+	if Session.Taxonomy is not None:
+		return(Session.Taxonomy)
+	TaxonomyFile = Session.TaxonomyFile
+	Cache = Session.Cache
+	Index = Taxonomy_KEGG.TaxonomyIndex.Load(TaxonomyFile) if TaxonomyFile else None
+	if Index is None or (Index.IsStale(Session.TaxonomyAge) and 
+		not (Cache is not None and Cache.Offline)):
+		print("Download organism taxonomy. . .")
+		try:
+			Download = CachedRequest("list", "organism", Session)
+		except RequestErrors:
+			if Index is None:
+				raise
+			print("Download failed, use the saved taxonomy index")
+		else:
+			Index = Taxonomy_KEGG.ParseOrganismList(Download)
+			if TaxonomyFile:
+				Index.Save(TaxonomyFile)
+	else:
+		print(f"Load organism taxonomy ({len(Index)} organisms)")
+	Session.Taxonomy = Index
+	return(Index)
+
+
+## ================================================================================================
+## Get the taxonomy of all organisms on KEGG as dict of orgID: Taxonomy (e.g. Prokaryotes-Bacteria)
+def DownloadTaxonomy(Session=None):
+	return(LoadTaxonomy(Session).GetLevel("Taxonomy"))
 
 
 ##-------------------------------------------------------------------------------------------------
-## SUB-FUNCTIONS OF DownloadNeighbors--------------------------------------------------------------
+## GENE ORDER FUNCTIONS ---------------------------------------------------------------------------
+##-------------------------------------------------------------------------------------------------
+## ================================================================================================
+## Sort the genes of an organism by chromosome and position --> KEGG-list
+## -> returns one line of tab-separated gene IDs per chromosome (None if no positions are given)
+def ParseGeneOrder(Download):
+	Chromosomes = {}
+	for Line in Download.split("\n"):
+		Columns = Line.split("\t")
+		if len(Columns) < 4:
+			continue
+		Match = PositionPattern.match(Columns[2])
+		if Match:
+			Chromosome = Match.group(1) or ""
+			Chromosomes.setdefault(Chromosome, []).append((int(Match.group(2)), Columns[0]))
+	if not Chromosomes:
+		return(None)
+	return("\n".join("\t".join(GeneID for Start, GeneID in sorted(Genes)) 
+		for Genes in Chromosomes.values()))
+
+
+## ================================================================================================
+## Create the lookup of all genes: GeneID -> (gene IDs of the chromosome, index in chromosome)
+def BuildGeneOrder(Text):
+	Order = {}
+	for Line in Text.split("\n"):
+		Genes = Line.split("\t")
+		for Index, GeneID in enumerate(Genes):
+			Order[GeneID] = (Genes, Index)
+	return(Order)
+
+
+## ================================================================================================
+## Download (or load from cache) the gene order of one organism
+## -> returns None if the gene order is not available (neighbors are then found by locus tag)
+def DownloadGeneOrder(orgID, Session=None):
+	Cache = (Session or DefaultSession).Cache
+	Key = "order/" + orgID
+	if Cache is not None:
+		Found = Cache.Get([Key])
+		if Key in Found:
+			Metrics.Count("Cache hits")
+			return(BuildGeneOrder(Found[Key]) if Found[Key] is not None else None)
+		Metrics.Count("Cache misses")
+		if Cache.Offline:
+			return(None)
+	try:
+		Text = ParseGeneOrder(KeggRequest("list", orgID, Session))
+	except RequestErrors:
+		return(None)
+	if Cache is not None:
+		Cache.Put({Key: Text})
+	return(BuildGeneOrder(Text) if Text is not None else None)
+
+
+## ================================================================================================
+## Get the gene order of all organisms, download each organism only once
+## -> only the most recently used organisms are kept in memory (MaxGeneOrders)
+def LoadGeneOrders(orgIDs, Workers=1, Session=None):
+	GeneOrders = (Session or DefaultSession).GeneOrders
+	Missing = [orgID for orgID in orgIDs if orgID not in GeneOrders]
+	if Missing:
+		print(f"Download gene order of {len(Missing)} organisms . . .")
+	if Workers > 1 and len(Missing) > 1:
+		with ThreadPoolExecutor(max_workers=min(Workers, len(Missing))) as Executor:
+			Results = list(Executor.map(lambda orgID: DownloadGeneOrder(orgID, Session), Missing))
+	else:
+		Results = [DownloadGeneOrder(orgID, Session) for orgID in Missing]
+	for orgID, Order in zip(Missing, Results):
+		GeneOrders[orgID] = Order
+	Orders = {}
+	for orgID in orgIDs:
+		GeneOrders.move_to_end(orgID)
+		Orders[orgID] = GeneOrders[orgID]
+	while len(GeneOrders) > max(MaxGeneOrders, len(orgIDs)):
+		GeneOrders.popitem(last=False)
+	return(Orders)
+
+
+## ================================================================================================
+## Get the gene order of the organism of the gene (None if the gene is not in the gene order)
+def GetGeneOrder(GeneID, Orders):
+	if not Orders:
+		return(None)
+	Order = Orders.get(GeneID.split(":",1)[0])
+	if Order is not None and GeneID in Order:
+		return(Order)
+	return(None)
+
+
+##-------------------------------------------------------------------------------------------------
+## SUB-FUNCTIONS OF DownloadCluster----------------------------------------------------------------
 ##-------------------------------------------------------------------------------------------------
 ## ================================================================================================
 ## Get list of indexes +/- range of the reference gene ID for KEGG
@@ -67,76 +438,382 @@ def GetNeighborIndices(Gene, Range, Step, Size=4):
 
 
 ## ================================================================================================
-## Download protein entries from KEGG -> in chunks of 10 gene IDs --> KEGG-get
-def DownloadProteinEntries(IndexList, GeneID):
-	Data = []
+## Get list of gene IDs +/- range of the reference gene ID from the gene order of its genome
+def GetOrderedNeighbors(Gene, Range, Order):
+	IndexList = []
+	IndexDict = {}
+	Genes, Index = Order[Gene]
+	for i in range(max(Index-Range, 0), min(Index+Range+1, len(Genes))):
+		if i != Index:
+			IndexList.append(Genes[i])
+			IndexDict[Genes[i]] = i - Index
+	return(IndexList, IndexDict)
+
+
+## ================================================================================================
+## Collect the neighbor IDs of all genes, remove duplicates and already known IDs
+## -> uses the gene order if available, otherwise the locus tag increment (Step)
+## -> returns the positions of the neighbors for each gene (None if the ID is not valid)
+## -> and the remaining IDs in chunks of 10 (maximum for one KEGG-get request)
+## -> IDs found in the cache are added to the known IDs and not downloaded again
+def PlanRequests(IDList, Range, Step, Known, Orders=None, Fields=None, Session=None):
+	Cache = (Session or DefaultSession).Cache
+	Plan = {}
+	Missing = []
+	Planned = set()
+	for GeneID in IDList:
+		try:
+			Order = GetGeneOrder(GeneID, Orders)
+			if Order is not None:
+				IndexList, IndexDict = GetOrderedNeighbors(GeneID, Range, Order)
+			else:
+				IndexList, IndexDict = GetNeighborIndices(GeneID, Range, Step)
+		except ValueError:
+			Plan[GeneID] = None
+			continue
+		Plan[GeneID] = IndexDict
+		for NewID in IndexList:
+			if NewID not in Known and NewID not in Planned:
+				Planned.add(NewID)
+				Missing.append(NewID)
+	if Cache is not None and Missing:
+		with Metrics.Stage("Load cached entries"):
+			Missing = LoadCachedEntries(Missing, Known, Fields, Session)
+	Batches = [Missing[x:x+10] for x in range(0, len(Missing), 10)]
+	return(Plan, Batches)
+
+
+## ================================================================================================
+## Add all cached entries to the dict of known IDs and return the IDs that still need downloading
+## -> in offline mode, IDs that are not cached are treated as not found on KEGG
+def LoadCachedEntries(IDList, Known, Fields=None, Session=None):
+	Cache = (Session or DefaultSession).Cache
+	Found = Cache.Get(IDList)
+	for NewID, Entry in Found.items():
+		if Entry is None:
+			Known[NewID] = None
+		else:
+			Known[NewID] = GetDetailedData(Entry.split("\n"), None, None, Fields)
+	Missing = [NewID for NewID in IDList if NewID not in Found]
+	Metrics.Count("Cache hits", len(Found))
+	Metrics.Count("Cache misses", len(Missing))
+	print(f"Found {len(Found)} of {len(IDList)} neighbor IDs in the cache")
+	if Cache.Offline:
+		for NewID in Missing:
+			Known[NewID] = None
+		Missing = []
+	return(Missing)
+
+
+## ================================================================================================
+## Split the downloaded lines into entries (lists of lines without line breaks) at each '///'
+def IterEntries(Lines):
 	Entry = []
-	try:
-		Download = REST.kegg_get(IndexList).read()
-	except:
-		Download = ""
-	Download = Download.split("\n")
-	for Line in Download:
+	for Line in Lines:
 		if Line.startswith("///"):
-			Data.append(Entry)
+			yield(Entry)
 			Entry = []
 		else:
-			Entry.append(Line)
+			Entry.append(Line.rstrip("\n"))
+
+
+## ================================================================================================
+## Download protein entries from KEGG -> in chunks of 10 gene IDs --> KEGG-get
+## -> entries are parsed while the response is downloaded
+## -> returns list of (protein data, raw entry for the cache) or None if the download failed
+def DownloadProteinEntries(IndexList, Fields=None, Session=None):
+	Cache = (Session or DefaultSession).Cache
+	Data = []
+	try:
+		with Metrics.Stage("Download and parse entries"):
+			for Entry in IterEntries(KeggStream("get", "+".join(IndexList), Session)):
+				Protein = GetDetailedData(Entry, None, None, Fields)
+				Data.append((Protein, "\n".join(Entry) if Cache is not None else None))
+	except KeggError as Error:
+		if Error.Status != 404:
+			Metrics.Count("Failed requests")
+			return(None)
+	except RequestErrors:
+		Metrics.Count("Failed requests")
+		return(None)
+	Metrics.Count("IDs requested", len(IndexList))
+	Metrics.Count("Entries parsed", len(Data))
 	return(Data)
 
 
+## ================================================================================================
+## Functions reading a field of the KEGG flat file (Value = field without tag and double spaces)
+def ReadEntry(Dict, Value):
+	Dict["Entry"] = Value.split(" ",1)[0]
+
+def ReadName(Dict, Value):
+	Dict["Name"] = Value.replace("(GenBank)", "").strip()
+
+def ReadOrthology(Dict, Value):
+	Dict["KO-ID"] = sys.intern(Value.split(" ",1)[0])
+
+def ReadOrganism(Dict, Value):
+	Values = Value.split(" ",1)
+	Dict["orgID"] = sys.intern(Values[0])
+	Dict["Organism"] = Values[1] if len(Values) > 1 else ""
+
+def ReadMotif(Dict, Value):
+	Dict["Domain"] = Value.replace("Pfam:", "").strip()
+
+def ReadDBLinks(Dict, Value):
+	if Value.startswith("UniProt:"):
+		Dict["UniProt"] = Value.split(" ",1)[1]
+
+def ReadLength(Dict, Value):
+	Dict["Length"] = Value
+
+# Field tag: (column, function reading the field) -> ENTRY and ORGANISM are always read
+FieldParsers = {
+	"ENTRY": ("ID", ReadEntry),
+	"NAME": ("Name", ReadName),
+	"ORTHOLOGY": ("KO-ID", ReadOrthology),
+	"ORGANISM": ("orgID", ReadOrganism),
+	"VIRUS": ("orgID", ReadOrganism),
+	"MOTIF": ("Domain", ReadMotif),
+	"DBLINKS": ("UniProt", ReadDBLinks),
+	"AASEQ": ("Length", ReadLength)}
+
+# Fields whose following (indented) lines are read as well
+MultiLineFields = {"DBLINKS"}
+
+# All columns that can be selected with Fields (the sequence is read in GetDetailedData)
+AllFields = ("Sequence", "Name", "KO-ID", "Organism", "Domain", "UniProt", "Length")
+
+
+## ================================================================================================
+## Select the functions for the fields needed (Fields=None for all, tuple of AllFields otherwise)
+@lru_cache(maxsize=None)
+def SelectParsers(Fields=None):
+	return({Tag: Parser for Tag, (Column, Parser) in FieldParsers.items()
+		if Fields is None or Column in Fields or Column in ("ID", "orgID")})
+
+
 ## ================================================================================================
 ## Download Info for each protein from KEGG
-def GetDetailedData(Entry, GeneID, orgID):
-	Dict = {"Ref": GeneID,"ID": orgID, "orgID": orgID,"Sequence": ""}
-	inAASeq = False
+## -> each field is read by the function of its tag, fields that are not needed are skipped
+## -> the sequence lines are collected and joined once
+def GetDetailedData(Entry, GeneID, orgID, Fields=None):
+	Parsers = SelectParsers(Fields)
+	Dict = {"Ref": GeneID,"ID": orgID, "orgID": orgID}
+	Sequence = None
+	if Fields is None or "Sequence" in Fields:
+		Dict["Sequence"] = ""
+		Sequence = []
+	Tag = ""
 	for Line in Entry:
-		Line = re.sub("\s\s+" , " ", Line)
-		Line = Line.strip()
-		if inAASeq == True:
-			if Line.startswith("NTSEQ"):
+		if Line[:1] != " ":
+			Tag = Line[:12].rstrip()
+			if Tag == "NTSEQ":
 				break
-			else:
-				Dict["Sequence"] += Line.strip()
-		if inAASeq == False:
-			if Line.startswith("ENTRY"):
-				Dict["ID"] += ":" + Line.split(" ",2)[1]
-			elif Line.startswith("NAME"):
-				Dict["Name"] = Line.split(" ",1)[1].replace("(GenBank)", "").strip()
-			elif Line.startswith("ORTHOLOGY"):
-				Dict["KO-ID"] = Line.split(" ",2)[1].strip()
-			elif Line.startswith("ORGANISM") or Line.startswith("VIRUS"):
-				Line = Line.split(" ",1)[1].strip()
-				Dict["Organism"] = Line.split(" ",1)[1]
-			elif Line.startswith("MOTIF"):
-				Dict["Domain"] = Line.split(" ",1)[1].replace("Pfam:", "").strip()
-			elif "UniProt" in Line:
-				Dict["UniProt"] = Line.split(" ",1)[1]
-			elif Line.startswith("AASEQ"):
-				Dict["Length"] = Line.split(" ",1)[1]
-				inAASeq = True
+		elif Tag == "AASEQ":
+			if Sequence is not None:
+				Sequence.append(Line.strip())
+			continue
+		elif Tag not in MultiLineFields:
+			continue
+		Parser = Parsers.get(Tag)
+		if Parser is not None:
+			Parser(Dict, " ".join(Line[12:].split()))
+	if Sequence:
+		Dict["Sequence"] = "".join(Sequence)
+	Name = Dict.pop("Entry", "")
+	if Dict["orgID"] is not None:
+		Dict["ID"] = Dict["orgID"] + ":" + Name
 	return(Dict)
 
 
+## ================================================================================================
+## Download all batches of IDs (in parallel) and add the entries to the dict of known IDs
+## -> each batch is added (and saved in the cache) as soon as it is downloaded, then Saved (if
+##    given) is called with the IDs of the batch
+## -> IDs that are not found on KEGG are saved as None to avoid downloading them again
+## -> IDs of failed downloads are added to Failed (if given) and not to the known IDs
+def DownloadBatches(Batches, Known, Workers=1, Fields=None, Failed=None, Saved=None, 
+	Session=None):
+	Cache = (Session or DefaultSession).Cache
+	def AddBatch(Batch, Data):
+		if Data is None:
+			if Failed is not None:
+				Failed.update(Batch)
+		else:
+			Downloaded = {}
+			for NewID in Batch:
+				Known[NewID] = None
+				Downloaded[NewID] = None
+			for Protein, Entry in Data:
+				if Protein["orgID"] is not None:
+					Known[Protein["ID"]] = Protein
+					Downloaded[Protein["ID"]] = Entry
+			if Cache is not None:
+				with Metrics.Stage("Save to cache"):
+					Cache.Put(Downloaded)
+		if Saved is not None:
+			Saved(Batch)
+	if Workers > 1 and len(Batches) > 1:
+		with ThreadPoolExecutor(max_workers=min(Workers, len(Batches))) as Executor:
+			Futures = {Executor.submit(DownloadProteinEntries, Batch, Fields, Session): Batch 
+				for Batch in Batches}
+			try:
+				for Future in as_completed(Futures):
+					AddBatch(Futures[Future], Future.result())
+			finally:
+				for Future in Futures:
+					Future.cancel()
+	else:
+		for Batch in Batches:
+			AddBatch(Batch, DownloadProteinEntries(Batch, Fields, Session))
+	return(Known)
+
+
+## ================================================================================================
+## Neighbor at a position of a reference gene (Protein is the dict of the downloaded entry)
+## -> the protein is not copied, all genes with the same neighbor share it
+## -> genes without neighbors (status Error) have one neighbor without position and protein
+class Neighbor:
+	__slots__ = ("Ref", "Pos", "Protein", "Status")
+
+	def __init__(self, Ref, Pos=None, Protein=None, Status=None):
+		self.Ref = Ref
+		self.Pos = Pos
+		self.Protein = Protein
+		self.Status = Status
+
+	# Row of the neighbors table (e.g. for the journal)
+	def ToDict(self):
+		Row = {"Ref": self.Ref}
+		if self.Protein is not None:
+			Row.update(self.Protein)
+			Row["Ref"] = self.Ref
+			Row["Pos"] = self.Pos
+		Row["Status"] = self.Status
+		return(Row)
+
+	@classmethod
+	def FromDict(cls, Row):
+		Protein = {Key: Value for Key, Value in Row.items() if Key not in ("Ref", "Pos", "Status")}
+		return(cls(Row["Ref"], Row.get("Pos"), Protein or None, Row.get("Status")))
+
+
+## ================================================================================================
+## Place the downloaded entries at the positions around the reference gene
+def AssembleNeighbors(GeneID, IndexDict, Known):
+	ProteinSet = []
+	for NewID, Pos in IndexDict.items():
+		if Known.get(NewID) is not None:
+			ProteinSet.append(Neighbor(GeneID, Pos, Known[NewID]))
+	return(ProteinSet)
+
+
+## ================================================================================================
+## Check if all entries for the range have been found and add the status to all neighbors
+## -> Error if the gene ID is not valid (ProteinSet=None) or if a download failed
+def SetStatus(GeneID, ProteinSet, Range, Error=False):
+	if ProteinSet is None or (Error and not ProteinSet):
+		Status = "Error"
+		ProteinSet = [Neighbor(GeneID)]
+	elif Error:
+		Status = "Error"
+	elif len(ProteinSet) == Range*2:
+		Status = "Complete"
+	else:
+		Status = "Incomplete"
+	for Protein in ProteinSet:
+		Protein.Status = Status
+	Metrics.Count("Genes " + Status)
+	return(ProteinSet)
+
+
 ##-------------------------------------------------------------------------------------------------
 ## MAIN FUNCTION ----------------------------------------------------------------------------------
 ##-------------------------------------------------------------------------------------------------
 ## ================================================================================================
-## Main function to download neighbors
-def DownloadNeighbors(GeneID, Range, Step=1):
-	print(f"Download neighbors of {GeneID} (Increment={Step}) . . .")
-	Data = []
-	ProteinSet = []
-	IDList, RangeDict = GetNeighborIndices(GeneID, Range, Step)
-	if Range > 5:
-		# Create chunks of clusters since data of 10 proteins can be downloaded from KEGG at once
-		ClusteredList = [IDList[x:x+10] for x in range(0, len(IDList), 10)]
-	else:
-		ClusteredList = [IDList]
-	for Cluster in ClusteredList:
-		Data.extend(DownloadProteinEntries(Cluster, GeneID))
-	for Entry in Data:
-		ProteinSet.append(GetDetailedData(Entry, GeneID, GeneID.split(":",1)[0]))
-	for Entry in ProteinSet:
-		Entry["Pos"] = RangeDict[Entry["ID"]]
-	return(ProteinSet)
\ No newline at end of file
+## Main function to download the neighbors of a cluster of genes
+## -> all neighbor IDs of the cluster are downloaded together in full requests of 10 IDs
+## -> neighbors are found in one pass by the gene order of each genome (UseOrder=True)
+## -> otherwise (or if not available) cycle through step size (1, 5, 10) of the locus tags
+##    for all genes where the correct one was not yet found
+## -> only the given Fields are read from the entries (None for all, see AllFields)
+## -> Finished (if given) is called with a list of (GeneID, neighbors) as soon as genes are done
+##    (after each downloaded batch that completes the neighbor IDs of genes)
+## -> Known (optional): dict of ID:protein of neighbors already downloaded (e.g. of a smaller range),
+##    only the other IDs are requested
+## -> Steps (optional): dict of GeneID:step of the locus tags found before (searched first), the
+##    step used for each gene is saved in it (0 for the gene order) before Finished is called
+## -> returns the list of neighbors (Neighbor) of all genes
+def DownloadCluster(IDList, Range, Workers=1, UseOrder=True, Fields=None, Finished=None, 
+	Known=None, Steps=None, Session=None):
+	Known = dict(Known) if Known else {}
+	Steps = {} if Steps is None else Steps
+	Failed = set()
+	Results = {}
+	Pending = list(IDList)
+	Orders = {}
+	if UseOrder:
+		with Metrics.Stage("Gene orders"):
+			Orders = LoadGeneOrders(list(dict.fromkeys(GeneID.split(":",1)[0] 
+				for GeneID in IDList)), Workers, Session)
+	for Step in (1, 5, 10):
+		Waiting = [GeneID for GeneID in Pending if Steps.get(GeneID, 1) > Step]
+		Pending = [GeneID for GeneID in Pending if Steps.get(GeneID, 1) <= Step]
+		if not Pending:
+			Pending = Waiting
+			continue
+		Plan, Batches = PlanRequests(Pending, Range, Step, Known, Orders, Fields, Session)
+		Metrics.Count(f"Genes searched with increment {Step}", len(Pending))
+		Metrics.Count(f"IDs requested with increment {Step}", sum(len(Batch) for Batch in Batches))
+		print(f"Download neighbors of {len(Pending)} genes in {len(Batches)} requests "
+			f"(Increment={Step}) . . .")
+
+		# Each gene is finished as soon as all of its neighbor IDs are downloaded (or failed)
+		# -> genes with too few neighbors are searched again with the next step
+		Requested = {}
+		Remaining = {}
+		for GeneID in Pending:
+			Remaining[GeneID] = 0
+			for NewID in Plan[GeneID] or ():
+				if NewID not in Known:
+					Requested.setdefault(NewID, []).append(GeneID)
+					Remaining[GeneID] += 1
+		Retry = set()
+		def FinishGenes(GeneIDs):
+			Done = []
+			for GeneID in GeneIDs:
+				if Plan[GeneID] is None:
+					Results[GeneID] = SetStatus(GeneID, None, Range)
+				elif any(NewID in Failed and NewID not in Known for NewID in Plan[GeneID]):
+					Results[GeneID] = SetStatus(GeneID, 
+						AssembleNeighbors(GeneID, Plan[GeneID], Known), Range, Error=True)
+				else:
+					ProteinSet = AssembleNeighbors(GeneID, Plan[GeneID], Known)
+					if len(ProteinSet) < Range + 1 and GetGeneOrder(GeneID, Orders) is None \
+						and Step != 10:
+						Retry.add(GeneID)
+						continue
+					Results[GeneID] = SetStatus(GeneID, ProteinSet, Range)
+				Steps[GeneID] = 0 if GetGeneOrder(GeneID, Orders) is not None else Step
+				Done.append((GeneID, Results[GeneID]))
+			if Finished is not None and Done:
+				Finished(Done)
+		def FinishBatch(Batch):
+			Ready = []
+			for NewID in Batch:
+				for GeneID in Requested.pop(NewID, ()):
+					Remaining[GeneID] -= 1
+					if Remaining[GeneID] == 0:
+						Ready.append(GeneID)
+			FinishGenes(Ready)
+		FinishGenes([GeneID for GeneID in Pending if Remaining[GeneID] == 0])
+		DownloadBatches(Batches, Known, Workers, Fields, Failed, FinishBatch, Session)
+		Pending = [GeneID for GeneID in Pending if GeneID in Retry] + Waiting
+		if not Pending:
+			break
+
+	Neighbors = []
+	for GeneID in IDList:
+		Neighbors.extend(Results[GeneID])
+	return(Neighbors)
@@ -0,0 +1,207 @@
+#!/usr/bin/python
+# Written in Python 3.8 in 2023 by A.L.O. Gaenssle
+
+# MODULE: FILTER AND COUNT TARGETS
+# -> matches all targets of one type (KO-ID, Name, Domain) at once with a combined pattern
+# -> each distinct value of the searched column is only matched once
+# -> counts the targets per position, per entry and per position of each entry
+# -> the counts per position of each entry are only saved for hits (dense table on request)
+# -> adds the counts of new targets to existing counts (without counting the others again)
+# -> combines the counts of partitions of the neighbors (e.g. counted in several processes)
+# -> counts the targets per taxon (e.g. Phylum) at each position
+
+import re
+import numpy as np
+import pandas as pd
+
+
+##-------------------------------------------------------------------------------------------------
+## MATCHING FUNCTIONS -----------------------------------------------------------------------------
+##-------------------------------------------------------------------------------------------------
+## ================================================================================================
+## Get the names of the target columns (e.g. KO-K21572) for all targets of each type
+def GetTargetColumns(TargetDict):
+	return([TargetType[:2] + "-" + Target for TargetType in TargetDict
+		for Target in TargetDict[TargetType]])
+
+
+## ================================================================================================
+## Combine all targets into one pattern (to skip values without any hit)
+## -> None if the targets cannot be joined: inline flags (e.g. (?i)) and backreferences (e.g. \1)
+##    only work in their own pattern
+def CombinePatterns(Targets):
+	if any(re.search(r"\(\?[aiLmsux-]|\(\?P=|\\[1-9]", Target) for Target in Targets):
+		return(None)
+	try:
+		return(re.compile("|".join("(?:" + Target + ")" for Target in Targets)))
+	except re.error:
+		return(None)
+
+
+## ================================================================================================
+## Match all targets (regular expressions) against the distinct values of one column
+## -> returns a boolean matrix with one row per row of the column and one column per target
+## -> each target is only searched in values matched by the combined pattern (if there is one)
+def MatchColumn(Values, Targets):
+	Codes, Uniques = pd.factorize(Values)
+	Combined = CombinePatterns(Targets)
+	Patterns = [re.compile(Target) for Target in Targets]
+
+	# The last row stays empty and is used for missing values (code -1)
+	Hits = np.zeros((len(Uniques) + 1, len(Targets)), dtype=bool)
+	for Index, Value in enumerate(Uniques):
+		Value = str(Value)
+		if Combined is None or Combined.search(Value):
+			for TargetIndex, Pattern in enumerate(Patterns):
+				Hits[Index, TargetIndex] = Pattern.search(Value) is not None
+	return(Hits[Codes])
+
+
+## ================================================================================================
+## Match all targets in their columns -> returns 0/1 dataframe (rows of ProteinData x targets)
+def MatchTargets(ProteinData, TargetDict):
+	Matrices = []
+	for TargetType in TargetDict:
+		if TargetDict[TargetType]:
+			if TargetType in ProteinData.columns:
+				Matrices.append(MatchColumn(ProteinData[TargetType], TargetDict[TargetType]))
+			else:
+				Matrices.append(np.zeros((len(ProteinData), len(TargetDict[TargetType])), dtype=bool))
+	if Matrices:
+		Matrix = np.hstack(Matrices)
+	else:
+		Matrix = np.zeros((len(ProteinData), 0), dtype=bool)
+	return(pd.DataFrame(Matrix.astype(np.int64), index=ProteinData.index,
+		columns=GetTargetColumns(TargetDict)))
+
+
+##-------------------------------------------------------------------------------------------------
+## COUNT FUNCTIONS --------------------------------------------------------------------------------
+##-------------------------------------------------------------------------------------------------
+## ================================================================================================
+## Count the targets at each range position, for each entry and at each position of each entry
+## -> the counts per position of each entry are saved as hits (one row per Ref, Pos and Target
+##    with a count, rows without hits are left out, see DensePositionCount for the table)
+## -> the counts per position and per entry are summed up from the hits
+def CountTargets(ProteinData, Matrix):
+	TargetColumns = list(Matrix.columns)
+	Rows, Columns = np.nonzero(Matrix.to_numpy())
+	Hits = pd.DataFrame({"Ref": ProteinData["Ref"].to_numpy()[Rows], 
+		"Pos": ProteinData["Pos"].to_numpy()[Rows], 
+		"Target": pd.Categorical.from_codes(Columns, categories=TargetColumns)})
+	PositionCount = Hits.groupby(["Ref", "Pos", "Target"], observed=True).size() \
+		.reset_index(name="Count")
+
+	# Count occcurences of each target at each range position and for each entry
+	RangeCount = SumHits(PositionCount, "Pos", np.sort(ProteinData["Pos"].unique()), TargetColumns)
+	EntryCount = SumHits(PositionCount, "Ref", sorted(ProteinData["Ref"].unique()), TargetColumns)
+	return(RangeCount, EntryCount, SortHits(PositionCount, TargetColumns))
+
+
+## ================================================================================================
+## Sum up the hits of each target for each value of Key (Pos or Ref, all Keys, also without hits)
+def SumHits(PositionCount, Key, Keys, TargetColumns):
+	Counts = pd.DataFrame()
+	if len(PositionCount):
+		Counts = PositionCount.pivot_table(index=Key, columns="Target", values="Count", 
+			aggfunc="sum", observed=True)
+	Counts = Counts.reindex(index=pd.Index(Keys, name=Key), columns=TargetColumns, fill_value=0)
+	Counts = Counts.fillna(0).astype(np.int64)
+	Counts.columns = list(Counts.columns)
+	return(Counts.reset_index())
+
+
+## ================================================================================================
+## Sort the hits by Ref, Pos and target (in the order of the target columns)
+def SortHits(PositionCount, TargetColumns):
+	PositionCount = PositionCount.astype({"Target": pd.CategoricalDtype(TargetColumns)})
+	return(PositionCount.sort_values(["Ref", "Pos", "Target"], kind="stable") \
+		.reset_index(drop=True))
+
+
+## ================================================================================================
+## Get the dense counts per position of each entry from the hits (Counts as from CountTargets)
+## -> one row per entry and one column per target and position (0 without hits) and their sums
+def DensePositionCount(Counts):
+	RangeCount, EntryCount, PositionCount = Counts
+	TargetColumns = list(EntryCount.columns[1:])
+	Positions = list(RangeCount["Pos"])
+	Dense = pd.DataFrame()
+	if len(PositionCount):
+		Dense = PositionCount.pivot_table(index="Ref", columns=["Target", "Pos"], values="Count", 
+			aggfunc="sum", observed=True)
+	Columns = pd.MultiIndex.from_product([TargetColumns, Positions], names=[None, "Pos"])
+	Dense = Dense.reindex(index=pd.Index(EntryCount["Ref"], name="Ref"), columns=Columns, 
+		fill_value=0).fillna(0).astype(np.int64)
+	Sum = pd.DataFrame(0, index=Dense.index, columns=pd.Index(Positions, name="Pos"))
+	for Target in TargetColumns:
+		Sum += Dense[Target]
+	Sum.columns = pd.MultiIndex.from_product([["SUM"], Positions], names=[None, "Pos"])
+	return(pd.concat([Dense, Sum], axis=1).reset_index())
+
+
+## ================================================================================================
+## Get the hits from the dense counts per position of each entry (as from DensePositionCount)
+def SparsePositionCount(Dense):
+	Counts = Dense.set_index(Dense.columns[0]).drop(columns="SUM", level=0)
+	TargetColumns = list(dict.fromkeys(Counts.columns.get_level_values(0)))
+	Counts = Counts.stack(level="Pos").stack()
+	Counts.index.names = ["Ref", "Pos", "Target"]
+	PositionCount = Counts[Counts > 0].reset_index(name="Count")
+	return(SortHits(PositionCount, TargetColumns))
+
+
+## ================================================================================================
+## Combine the counts of partitions of the neighbors (list of counts as returned by CountTargets)
+## -> the counts of genes found in several partitions are added up
+def CombineCounts(Parts, TargetColumns):
+	RangeCount = pd.concat([Part[0] for Part in Parts]).groupby("Pos")[TargetColumns].sum() \
+		.reset_index()
+	EntryCount = pd.concat([Part[1] for Part in Parts]).groupby("Ref")[TargetColumns].sum() \
+		.reset_index()
+	PositionCount = pd.concat([Part[2] for Part in Parts]) \
+		.groupby(["Ref", "Pos", "Target"], observed=True)["Count"].sum().reset_index()
+	return(RangeCount, EntryCount, SortHits(PositionCount, TargetColumns))
+
+
+## ================================================================================================
+## Merge counts of new targets into existing counts (both as returned by CountTargets)
+## -> only the given target columns are kept (in their order)
+## -> NewCounts=None if there are no new targets (e.g. targets were only removed)
+def MergeCounts(Counts, NewCounts, TargetColumns):
+	RangeCount, EntryCount, PositionCount = Counts
+	Counted = [Column for Column in TargetColumns if Column in RangeCount.columns]
+	RangeCount, EntryCount = RangeCount[["Pos"] + Counted], EntryCount[["Ref"] + Counted]
+	PositionCount = PositionCount[PositionCount["Target"].isin(Counted)]
+	if NewCounts is not None:
+		RangeCount = RangeCount.merge(NewCounts[0], on="Pos", how="outer", sort=False)
+		EntryCount = EntryCount.merge(NewCounts[1], on="Ref", how="outer", sort=False)
+		PositionCount = pd.concat([PositionCount.astype({"Target": str}), 
+			NewCounts[2].astype({"Target": str})])
+	RangeCount = RangeCount[["Pos"] + TargetColumns].fillna(0).astype(np.int64)
+	EntryCount = EntryCount[["Ref"] + TargetColumns].fillna(0)
+	EntryCount[TargetColumns] = EntryCount[TargetColumns].astype(np.int64)
+	return(RangeCount, EntryCount, SortHits(PositionCount, TargetColumns))
+
+
+## ================================================================================================
+## Count the targets at each position for each taxon (Counts as from CountTargets, Taxa: taxon of
+## each entry of EntryCount, e.g. its phylum) -> columns Level, Pos, Genes (reference genes of the 
+## taxon) and targets (one row for each taxon and position)
+def CountTaxonomy(Counts, Taxa, Level):
+	RangeCount, EntryCount, PositionCount = Counts
+	TargetColumns = list(EntryCount.columns[1:])
+	Taxa = pd.Series(pd.Series(Taxa).to_numpy(), index=EntryCount["Ref"])
+	Genes = Taxa.value_counts()
+	Hits = PositionCount.assign(**{Level: PositionCount["Ref"].map(Taxa)})
+	Index = pd.MultiIndex.from_product([sorted(Genes.index), RangeCount["Pos"]], 
+		names=[Level, "Pos"])
+	Counts = pd.DataFrame()
+	if len(Hits):
+		Counts = Hits.pivot_table(index=[Level, "Pos"], columns="Target", values="Count", 
+			aggfunc="sum", observed=True)
+	Counts = Counts.reindex(index=Index, columns=TargetColumns, fill_value=0).fillna(0) \
+		.astype(np.int64)
+	Counts.columns = list(Counts.columns)
+	Counts.insert(0, "Genes", Genes.reindex(Index.get_level_values(0)).to_numpy())
+	return(Counts.reset_index())
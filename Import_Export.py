@@ -4,12 +4,27 @@
 # MODULE: EXPORT DATA AND CHECK FILES
 # -> create new folder
 # -> check if files exists and give an option to rename the file
-# -> Combine files (sets of entries) into a large dataframe
+# -> Combine files (sets of entries) into one large file without loading all at once
 # -> export pandas dataframe to defined filetype with set separator (Main.py)
+# -> import/export columnar files (.parquet, .feather) with typed columns (requires pyarrow)
+# -> read large files in parts (only one part in memory at a time)
+# -> keep a journal of the finished genes of a download until their fragment is saved
 
 import pandas as pd
 import os
 import re
+import json
+
+# File types saved in columns (binary) instead of text
+ColumnarTypes = (".parquet", ".feather")
+
+# Columns saved as categories or integers in columnar files
+CategoryColumns = ["orgID", "KO-ID", "Taxonomy", "Status"]
+IntegerColumns = ["Length", "Pos"]
+
+# Fields of each gene in the journal and of the manifest of the fragments
+JournalFields = ["Ref", "Status", "Range", "Step", "Neighbors"]
+ManifestFields = ["Range", "ClusterSize", "Genes", "IDHash", "Fragments", "FragmentRanges", "Steps"]
 
 ##-------------------------------------------------------------------------------------------------
 ## HELPER FUNCTIONS -------------------------------------------------------------------------------
@@ -43,19 +58,247 @@ def CheckFileExists(FileName, Ask):
 			FileName = input("\nEnter a new filename\n")
 	return(FileName)
 
+## ================================================================================================
+## Set column types for columnar files (categories, integers) and flatten multilevel columns
+def SetColumnTypes(DataFrame):
+	DataFrame = DataFrame.copy()
+	if isinstance(DataFrame.columns, pd.MultiIndex):
+		DataFrame.columns = ["_".join(str(Level) for Level in Column if str(Level) != "")
+			for Column in DataFrame.columns]
+	for Column in IntegerColumns:
+		if Column in DataFrame.columns:
+			DataFrame[Column] = pd.to_numeric(DataFrame[Column], errors="coerce").astype("Int64")
+	for Column in CategoryColumns:
+		if Column in DataFrame.columns:
+			DataFrame[Column] = DataFrame[Column].astype("category")
+	return(DataFrame)
+
+## ================================================================================================
+## Import a dataframe from a text or columnar file (Columns=None for all columns)
+## -> only the given columns are loaded, columns not in the file are ignored
+def ImportDataFrame(FileName, Sep=";", Columns=None):
+	if FileName.endswith(".parquet"):
+		if Columns is not None:
+			import pyarrow.parquet
+			Available = pyarrow.parquet.read_schema(FileName).names
+			Columns = [Column for Column in Columns if Column in Available]
+		return(pd.read_parquet(FileName, columns=Columns))
+	elif FileName.endswith(".feather"):
+		if Columns is not None:
+			import pyarrow
+			Available = pyarrow.ipc.open_file(pyarrow.memory_map(FileName)).schema.names
+			Columns = [Column for Column in Columns if Column in Available]
+		return(pd.read_feather(FileName, columns=Columns))
+	if Columns is not None:
+		return(pd.read_csv(FileName, sep=Sep, usecols=lambda Column: Column in Columns))
+	return(pd.read_csv(FileName, sep=Sep))
+
+## ================================================================================================
+## Read a text or columnar file in parts of (at most) Rows rows -> yields one dataframe per part
+## -> only one part is kept in memory at a time, only the given columns are loaded
+def IterDataFrame(FileName, Sep=";", Columns=None, Rows=500000):
+	if FileName.endswith(ColumnarTypes):
+		import pyarrow
+		if FileName.endswith(".parquet"):
+			import pyarrow.parquet
+			File = pyarrow.parquet.ParquetFile(FileName)
+			Batches = File.iter_batches(batch_size=Rows, columns=Columns and
+				[Column for Column in Columns if Column in File.schema_arrow.names])
+		else:
+			Reader = pyarrow.ipc.open_file(pyarrow.memory_map(FileName))
+			Batches = (Reader.get_batch(Index) for Index in range(Reader.num_record_batches))
+		for Batch in Batches:
+			if Columns is not None:
+				Batch = Batch.select([Column for Column in Columns if Column in Batch.schema.names])
+			for Start in range(0, Batch.num_rows, Rows):
+				yield(Batch.slice(Start, Rows).to_pandas())
+	else:
+		yield from pd.read_csv(FileName, sep=Sep, chunksize=Rows, 
+			usecols=None if Columns is None else lambda Column: Column in Columns)
+
+## ================================================================================================
+## Get the column names of a text or columnar file without loading the data
+def ReadColumnNames(FileName, Sep=";"):
+	if FileName.endswith(".parquet"):
+		import pyarrow.parquet
+		return(pyarrow.parquet.read_schema(FileName).names)
+	elif FileName.endswith(".feather"):
+		import pyarrow
+		return(pyarrow.ipc.open_file(pyarrow.memory_map(FileName)).schema.names)
+	return(list(pd.read_csv(FileName, sep=Sep, nrows=0).columns))
+
+## ================================================================================================
+## Import the counts per position of each entry (_PositionCount) with two column levels
+## -> (target, position) as saved from the pivot table (columnar files: "target_position")
+def ImportPositionCount(FileName, Sep=";"):
+	if FileName.endswith(ColumnarTypes):
+		DataFrame = ImportDataFrame(FileName, Sep)
+		Columns = [Column.rsplit("_", 1) for Column in DataFrame.columns[1:]]
+	else:
+		DataFrame = pd.read_csv(FileName, sep=Sep, header=[0, 1])
+		Columns = list(DataFrame.columns[1:])
+	DataFrame.columns = pd.MultiIndex.from_tuples([("Ref", "")] + [(Target, int(Pos)) 
+		for Target, Pos in Columns], names=[None, "Pos"])
+	return(DataFrame)
+
+## ================================================================================================
+## Get the size and modification time of a file (to check if it changed since it was used)
+def GetFileState(FileName):
+	if not os.path.exists(FileName):
+		return(None)
+	Stat = os.stat(FileName)
+	return({"Size": Stat.st_size, "Modified": Stat.st_mtime_ns})
+
+## ================================================================================================
+## Save and load the manifest (list of fragment files and settings) of a download
+def WriteManifest(FileName, Manifest):
+	with open(FileName + ".tmp", "w") as File:
+		json.dump(Manifest, File, indent=1)
+	os.replace(FileName + ".tmp", FileName)
+
+def ReadManifest(FileName):
+	if not os.path.exists(FileName):
+		return(None)
+	with open(FileName) as File:
+		return(json.load(File))
+
+## ================================================================================================
+## Add the neighbors of finished genes (list of (GeneID, neighbors)) to the journal
+## -> one line per gene, written to disk immediately, so that no finished gene is lost in a crash
+## -> each line records the range and the locus tag step (dict of GeneID:step, 0 for the gene order)
+##    with which the neighbors (positions in the rows) were searched
+## -> an incomplete last line (e.g. if the program crashed while writing) is removed first
+def AppendJournal(FileName, Genes, Range, Steps=None):
+	TruncateLine(FileName)
+	with open(FileName, "a") as File:
+		for GeneID, Neighbors in Genes:
+			Status = Neighbors[0]["Status"] if Neighbors else "Incomplete"
+			Gene = {"Ref": GeneID, "Status": Status, "Range": Range, 
+				"Step": Steps.get(GeneID) if Steps else None, "Neighbors": Neighbors}
+			File.write(json.dumps(Gene) + "\n")
+		File.flush()
+		os.fsync(File.fileno())
+
+## ================================================================================================
+## Load all genes in the journal -> returns dict of GeneID:gene (last entry of each gene)
+## -> each gene is a dict of Ref, Status, Range, Step and Neighbors
+## -> incomplete lines (e.g. if the program crashed while writing) and lines without all fields
+##    are ignored (the genes are downloaded again)
+def ReadJournal(FileName):
+	Journal = {}
+	if not os.path.exists(FileName):
+		return(Journal)
+	with open(FileName) as File:
+		for Line in File:
+			try:
+				Gene = json.loads(Line)
+			except ValueError:
+				continue
+			if not isinstance(Gene, dict) or any(Key not in Gene for Key in JournalFields):
+				continue
+			Journal[Gene["Ref"]] = Gene
+	return(Journal)
+
+## ================================================================================================
+## Remove genes (e.g. of a saved fragment) from the journal, only the last entry of each other
+## gene is kept (the journal is deleted if no gene is left)
+def CompactJournal(FileName, GeneIDs):
+	if not os.path.exists(FileName):
+		return
+	GeneIDs = set(GeneIDs)
+	Journal = ReadJournal(FileName)
+	Genes = [Gene for GeneID, Gene in Journal.items() if GeneID not in GeneIDs]
+	if not Genes:
+		os.remove(FileName)
+		return
+	with open(FileName + ".tmp", "w") as File:
+		for Gene in Genes:
+			File.write(json.dumps(Gene) + "\n")
+		File.flush()
+		os.fsync(File.fileno())
+	os.replace(FileName + ".tmp", FileName)
+
+## ================================================================================================
+## Cut a text file after its last line break (removes an incomplete last line)
+def TruncateLine(FileName, BlockSize=65536):
+	if not os.path.exists(FileName):
+		return
+	with open(FileName, "r+b") as File:
+		End = File.seek(0, os.SEEK_END)
+		Position = End
+		while Position > 0:
+			Start = max(0, Position - BlockSize)
+			File.seek(Start)
+			Index = File.read(Position - Start).rfind(b"\n")
+			if Index >= 0:
+				Position = Start + Index + 1
+				break
+			Position = Start
+		if Position < End:
+			File.truncate(Position)
+
+## ================================================================================================
+## Get the schema of columnar files (strings, except categories and integers)
+## -> Dictionary=False saves the categories as strings (feather files only allow one dictionary
+##    per column for all fragments)
+def GetSchema(Columns, Dictionary=True):
+	import pyarrow
+	Fields = []
+	for Column in Columns:
+		if Column in CategoryColumns and Dictionary:
+			Fields.append(pyarrow.field(Column, pyarrow.dictionary(pyarrow.int32(), pyarrow.string())))
+		elif Column in IntegerColumns:
+			Fields.append(pyarrow.field(Column, pyarrow.int64()))
+		else:
+			Fields.append(pyarrow.field(Column, pyarrow.string()))
+	return(pyarrow.schema(Fields))
+
 ## ================================================================================================
 ## Copy all data from Fragment files (250-500 genes/file) into one large file
-def CombineFiles(Folder, Sep, FileType):
-	FileListAll = os.listdir(Folder)
-	FileList = list(filter(lambda File: File.endswith(FileType), FileListAll))
-	DataList = []
+## -> the fragments (list of file paths) are appended one by one in the given order,
+##    so only one fragment is kept in memory at a time
+## -> columns missing in some fragments are left empty, the rows of each fragment are sorted
+## -> only rows of the given reference genes are kept (Refs=set of gene IDs, None for all)
+def CombineFiles(FileList, FileName, Sep, FileType, Ask=True, Refs=None):
+	FileName = CheckFileExists(FileName + FileType, Ask)
+	TempName = FileName + ".tmp"
+	Columns = []
 	for File in FileList:
-		FilePath = os.path.join(Folder, File)
-		DataFrame = pd.read_csv(FilePath, sep=Sep)
-		DataList.append(DataFrame)
-	DataFrame = pd.concat(DataList, axis=0, ignore_index=True)
-	DataFrame = DataFrame.sort_values(DataFrame.columns[0])
-	return(DataFrame)
+		for Column in ReadColumnNames(File, Sep):
+			if Column not in Columns:
+				Columns.append(Column)
+	Writer = None
+	for Index, File in enumerate(FileList):
+		DataFrame = ImportDataFrame(File, Sep).reindex(columns=Columns)
+		if Refs is not None:
+			DataFrame = DataFrame[DataFrame[Columns[0]].isin(Refs)]
+		DataFrame = DataFrame.sort_values(Columns[0], kind="stable")
+		for Column in IntegerColumns:
+			if Column in Columns:
+				DataFrame[Column] = pd.to_numeric(DataFrame[Column], errors="coerce") \
+					.fillna(0).astype(int)
+		if FileType in ColumnarTypes:
+			import pyarrow
+			DataFrame = DataFrame.astype({Column: "object" for Column in Columns 
+				if Column not in IntegerColumns})
+			DataFrame = DataFrame.where(DataFrame.notna(), None)
+			if Writer is None:
+				Schema = GetSchema(Columns, Dictionary=(FileType == ".parquet"))
+				if FileType == ".parquet":
+					import pyarrow.parquet
+					Writer = pyarrow.parquet.ParquetWriter(TempName, Schema)
+				else:
+					Writer = pyarrow.ipc.new_file(TempName, Schema)
+			Writer.write_table(pyarrow.Table.from_pandas(DataFrame, schema=Schema, 
+				preserve_index=False))
+		else:
+			DataFrame.to_csv(TempName, sep=Sep, index=False, header=(Index == 0), 
+				mode="w" if Index == 0 else "a")
+	if Writer is not None:
+		Writer.close()
+	os.replace(TempName, FileName)
+	print(f"Combined {len(FileList)} fragments, file saved as:", FileName, "\n")
+	return(FileName)
 
 
 ##-------------------------------------------------------------------------------------------------
@@ -63,16 +306,27 @@ def CombineFiles(Folder, Sep, FileType):
 ##-------------------------------------------------------------------------------------------------
 ## ================================================================================================
 ## Export pandas dataframe
+## -> the file is written under a temporary name and then renamed, so it is never half-written
 def ExportDataFrame(DataFrame, FileName, Add="", Columns="", 
 	FileType=".csv", Sep=";", Ask=True, Header=True):
 	FileName = FileName + Add + FileType
 	FileName = CheckFileExists(FileName, Ask)
-	if Columns == "":
-		Columns = list(DataFrame)
-	try:
-		DataFrame.to_csv(FileName, sep=Sep, columns = Columns, index=False, header=Header)
-		
-	# Account for mutlilevel index columns
-	except TypeError:
-		DataFrame.to_csv(FileName, sep=Sep, index=False, header=Header)
+	TempName = FileName + ".tmp"
+	if FileType in ColumnarTypes:
+		DataFrame = SetColumnTypes(DataFrame if Columns == "" else DataFrame[Columns])
+		if FileType == ".parquet":
+			DataFrame.to_parquet(TempName, index=False)
+		else:
+			DataFrame.to_feather(TempName)
+	else:
+		if Columns == "":
+			Columns = list(DataFrame)
+
+		# Multilevel columns (e.g. dense counts per position) are saved with one header row per level
+		if isinstance(DataFrame.columns, pd.MultiIndex):
+			DataFrame.to_csv(TempName, sep=Sep, index=False, header=Header)
+		else:
+			DataFrame.to_csv(TempName, sep=Sep, columns = Columns, index=False, header=Header)
+	os.replace(TempName, FileName)
 	print("File saved as:", FileName, "\n")
+	return(FileName)
@@ -2,13 +2,12 @@
 # Written in Python 3.8 in 2023 by A.L.O. Gaenssle
 
 import os
-import re
-import pandas as pd
+import sys
 import argparse
 
-# Own modules
-import Import_Export as IE
-import Download_KEGG as KEGG
+# Own modules (the analysis loads pandas and is only imported after the arguments are checked)
+import Cache_KEGG
+import Taxonomy_KEGG
 
 
 ## ------------------------------------------------------------------------------------------------
@@ -23,6 +22,10 @@ parser = argparse.ArgumentParser(description="VICINITY ANALYZER"
     "\nThe occurrences of each provided target is counted per entry and per position")
 parser.add_argument("input", 
 	help="KO ID, KEGG gene ID(s) or file containing KEGG gene IDs (e.g. blb:BBMN68_1454,blf:BLIF_1909)")
+parser.add_argument("-b", "--batch", 
+	help="the input is a list of inputs (comma-separated or file with one input per line), "
+	"neighbors shared by the inputs are downloaded only once",
+	action="store_true")
 parser.add_argument("-ask", "--askoverwrite", 
 	help="ask before overwriting files",
 	action="store_true")
@@ -36,7 +39,8 @@ parser.add_argument("-tf", "--targetFile",
 	help="File containing target;type pairs used for filtering (types=[KO-ID, Name, Domain], sep=-sep)")
 parser.add_argument("-a", "--action", 
 	help="add actions to be conducted: "
-	"a=all, i=retrieve IDs, g=get neighbors, f=filter with target(default: %(default)s)", 
+	"a=all, i=retrieve IDs, g=get neighbors, f=filter with target, "
+	"s=export sequences of the target hits as FASTA (default: %(default)s)", 
 	default="a")
 parser.add_argument("-r", "--range", 
 	help="+/- range in which genes will be searched (default: %(default)s)", 
@@ -51,30 +55,124 @@ parser.add_argument("-cs", "--clustersize",
 	default=25, 
 	type=int)
 parser.add_argument("-ft", "--filetype", 
-	help="type of the generated files (default: %(default)s)", 
+	help="type of the generated files, .parquet and .feather save typed columns "
+	"and require pyarrow (default: %(default)s)", 
 	default=".csv")
 parser.add_argument("-sep", "--separator", 
 	help="separator between columns in the output files (default: %(default)s)", 
 	default=";")
+parser.add_argument("-w", "--workers", 
+	help="number of genes downloaded at the same time (default: %(default)s)", 
+	default=1, 
+	type=int)
+parser.add_argument("-cw", "--countworkers", 
+	help="number of processes counting the targets in partitions of the neighbors "
+	"(default: %(default)s)", 
+	default=1, 
+	type=int)
+parser.add_argument("-pr", "--partitionrows", 
+	help="rows of the neighbors file per partition counted by one process (default: %(default)s)", 
+	default=500000, 
+	type=int)
+parser.add_argument("-cf", "--countfragments", 
+	help="count the targets in the fragment files (one partition each) instead of "
+	"the combined neighbors file (not in batch mode)",
+	action="store_true")
+parser.add_argument("-dp", "--denseposition", 
+	help="save the counts per position of each entry as table with one column per target and "
+	"position (default: one row per hit with Ref, Pos, Target and Count)",
+	action="store_true")
+parser.add_argument("-rps", "--requestrate", 
+	help="maximal number of requests per second sent to KEGG by all workers (default: %(default)s)", 
+	default=3, 
+	type=float)
+parser.add_argument("-url", "--keggurl", 
+	help="address of the KEGG REST API, e.g. a local mirror (default: %(default)s)", 
+	default="https://rest.kegg.jp")
+parser.add_argument("-rt", "--retries", 
+	help="number of retries of requests that failed (KEGG busy or connection lost), "
+	"with increasing waiting time (default: %(default)s)", 
+	default=4, 
+	type=int)
+parser.add_argument("-ins", "--insecure", 
+	help="do not verify the certificate of the KEGG server (e.g. for a local mirror)",
+	action="store_true")
+parser.add_argument("-nm", "--neighbormode", 
+	help="find neighbors by gene order of the genome or by locus tag increments (default: %(default)s)", 
+	choices=["order", "locus"], 
+	default="order")
+parser.add_argument("-ns", "--nosequence", 
+	help="do not save the sequences of the neighbors (e.g. if only targets are counted)",
+	action="store_true")
+parser.add_argument("-ss", "--sequencestore", 
+	help="save the sequences in an indexed FASTA file (<name>_Sequences.fasta/.fai) "
+	"instead of the neighbors file",
+	action="store_true")
+parser.add_argument("-sp", "--sequencepos", 
+	help="positions of the neighbors exported with action s, separated by spaces "
+	"(e.g. -sp -1 1, default: all)", 
+	nargs="+", 
+	type=int)
+parser.add_argument("-re", "--retryerrors", 
+	help="download genes with errors or incomplete neighbors again and update the files",
+	action="store_true")
+parser.add_argument("-cache", "--cachefile", 
+	help="local file in which downloaded KEGG entries are kept for later runs (default: %(default)s)", 
+	default=Cache_KEGG.DefaultFile)
+parser.add_argument("-tax", "--taxonomyfile", 
+	help="local file of the taxonomy index of all KEGG organisms, downloaded again after "
+	"--cacheage days (default: %(default)s)", 
+	default=Taxonomy_KEGG.DefaultFile)
+parser.add_argument("-tl", "--taxonomylevels", 
+	help="count the targets per taxon of these levels at each position, comma-separated "
+	"(Kingdom, Phylum, Class, Order, e.g. Phylum,Class)")
+parser.add_argument("-nc", "--nocache", 
+	help="do not use the local cache of KEGG entries",
+	action="store_true")
+parser.add_argument("-ca", "--cacheage", 
+	help="days after which cached entries are downloaded again (default: %(default)s)", 
+	default=30, 
+	type=float)
+parser.add_argument("-cm", "--cachesize", 
+	help="maximal size of the cache in MB, oldest entries are removed first (default: %(default)s)", 
+	default=2048, 
+	type=float)
+parser.add_argument("-off", "--offline", 
+	help="only use entries from the cache and do not download anything from KEGG",
+	action="store_true")
+parser.add_argument("-mf", "--metricsfile", 
+	help="file of the run metrics (stage times, requests, cache hits, errors), "
+	".json or .csv (default: <folder>/VicinityAnalysis/<name>_Metrics.json)")
+parser.add_argument("-prof", "--profile", 
+	help="profile the run with cProfile and save <name>_Profile.prof/.txt "
+	"(only the main thread, use -w 1 to include the downloads)",
+	action="store_true")
+parser.add_argument("-ni", "--noninteractive", 
+	help="never ask for input (e.g. in scripts): invalid actions are an error, missing targets "
+	"are ignored, the name is taken from the input and files are overwritten",
+	action="store_true")
 
 
 
 args = parser.parse_args()
 
 # Check if the given action is valid and replace with the list if == 'a'
-while all(ch in "aigf" for ch in args.action) == False:
+if args.noninteractive and all(ch in "aigfs" for ch in args.action) == False:
+	parser.error(f"invalid action '{args.action}' (any of a, i, g, f, s)")
+while all(ch in "aigfs" for ch in args.action) == False:
     args.action = input("\nWhich action do you want to conduct?"
         "\n- a\tconduct all actions\n- i\tdownload sequence IDs"
-        "\n- g\tget neighbors\n- f\tfilter with target\n"
+        "\n- g\tget neighbors\n- f\tfilter with target"
+        "\n- s\texport sequences of the target hits\n"
         "\nPlease enter any or multiple of letters (e.g 'a' or 'igf' [without ''])\n")
 if "a" in args.action:
-    args.action = "igf"
+    args.action = args.action.replace("a", "igf")
 
 # Check if targets were given
 if all(target == None for target in [args.targetID, args.targetDomain,
 	args.targetName, args.targetFile]):
 	while True:
-		if "f" not in args.action:
+		if not any(s in ["f", "s"] for s in args.action) or args.noninteractive:
 			break
 		Continue = input("\nNo target for filtering were given\t->Do you want to continue without?"
 			"\n(y=yes, n=no)\n")
@@ -87,105 +185,45 @@ if all(target == None for target in [args.targetID, args.targetDomain,
 		else:
 			print("Please enter 'y' or 'no'!")
 
+# Import the analysis (and pandas) only after the arguments have been checked
+import VicinityAnalyzer as VA
+import Import_Export as IE
+import Run_Metrics as Metrics
+if args.noninteractive:
+	args.askoverwrite = False
+
 # Set file and folder name
 if args.name == None:
 	if os.path.isfile(args.input):
 		args.folder, args.name = os.path.split(args.input)
 		args.name = args.name.rsplit(".",1)[0]
+	elif args.noninteractive:
+		args.name = VA.GetInputName(args.input)
 	else:
 		args.name = input("\nPlease enter a name for the created files (e.g. Test)\n")
-		if args.folder == None:
-			args.folder = args.name
+if args.folder == None:
+	args.folder = args.name
+if args.metricsfile == None:
+	args.metricsfile = os.path.join(args.folder, "VicinityAnalysis", args.name + "_Metrics.json")
+
+
 
+# Offline mode only works with the cache
+if args.offline and args.nocache:
+	parser.error("the offline mode (-off) requires the cache, remove -nc (--nocache)")
 
+# Check the levels of the taxonomy
+Levels = None
+if args.taxonomylevels:
+	Levels = [Level.strip().capitalize() for Level in args.taxonomylevels.split(",")]
+	if any(Level not in Taxonomy_KEGG.Levels for Level in Levels):
+		parser.error(f"invalid taxonomy level in '{args.taxonomylevels}' "
+			f"(any of {', '.join(Taxonomy_KEGG.Levels)})")
 
 # Check for tab separator
 if args.separator in ["\\t", "tab", "'\\t'", "{tab}"]:
 	args.separator = "\t"
 
-## ------------------------------------------------------------------------------------------------
-## MAIN FUNCTIONS ---------------------------------------------------------------------------------
-## ------------------------------------------------------------------------------------------------
-## ================================================================================================
-## Get index list of neighbors and retrieves protein data
-def GetNeighbors(IDList, FilePath, Range, FileType, Sep, Ask, ClusterSize):
-	Organisms = None
-	print("Download protein data for", len(IDList), "IDs . . .")
-
-	# Create clusters of sequences to generate smaller files (in case the download crashes)
-	ClusteredList = [IDList[x:x+ClusterSize] for x in range(0, len(IDList), ClusterSize)]
-	for ClusterID in range(len(ClusteredList)):
-		print("Download cluster", ClusterID+1, "of", len(ClusteredList))
-		FragmentFile = FilePath + "_" + str(ClusterID+1)
-		print(FragmentFile)
-
-		# Ignore all files that have already been downloaded
-		if os.path.exists(FragmentFile + FileType):
-			print("File already exists, skip to next cluster\n")
-
-		# Download all files that have not yet been saved
-		else:
-			Neighbors = []
-			for GeneID in ClusteredList[ClusterID]:
-				try:
-					# Cycle through step size until the correct one is found
-					ProteinSet = KEGG.DownloadNeighbors(GeneID, Range, Step=1)
-					if len(ProteinSet) < Range + 1:
-						ProteinSet =  KEGG.DownloadNeighbors(GeneID, Range, Step=5)
-					if len(ProteinSet) < Range + 1:
-						ProteinSet =  KEGG.DownloadNeighbors(GeneID, Range, Step=10)
-
-					# Check if all entries for the range have been found 
-					if len(ProteinSet) == Range*2:
-						Status = "Complete"
-					else:
-						Status = "Incomplete"
-				except:
-					Status = "Error"
-					ProteinSet = [{"Ref":GeneID}]
-				for Protein in ProteinSet:
-					Protein["Status"] = Status
-					Neighbors.append(Protein)
-
-			# Only download the list of organisms on KEGG if needed and add to dataframe
-			if Organisms is None:
-				Organisms = KEGG.DownloadOrganismsTemp()
-			ProteinTable = pd.DataFrame(Neighbors)
-			ProteinTable = pd.merge(ProteinTable, Organisms, on=["orgID"],  how="left")
-			IE.ExportDataFrame(ProteinTable, FragmentFile, FileType=FileType, Sep=Sep, Ask=Ask)
-			StatusCount = ProteinTable.groupby('Ref').first().reset_index()
-			StatusCount = StatusCount.groupby(["Status"]).size()
-			print(f"Done!\n->Neighbors found: {len(ClusteredList[ClusterID])} searched",
-				f"\n{StatusCount.to_string()}\n")
-
-	# After all entries have been downloaded, combine all fragments into one dataframe
-	DataFrame = IE.CombineFiles(os.path.split(FragmentFile)[0], Sep, FileType)
-	DataFrame["Length"] = DataFrame["Length"].fillna(0).astype(int)
-	DataFrame["Pos"] = DataFrame["Pos"].fillna(0).astype(int)
-	return(DataFrame)
-
-
-def GetTargets(targetID, targetDomain, targetName, targetFile, Sep):
-	TargetDict = {}
-	TargetDict = {"KO-ID": targetID, "Name": targetName, "Domain": targetDomain}
-	for Target in TargetDict:
-		if TargetDict[Target]:
-			TargetDict[Target] = TargetDict[Target].split(",")
-		else:
-			TargetDict[Target] = []
-	if targetFile != None:
-		with open(targetFile) as File:
-			for Line in File:
-				(Target, TargetType) = Line.strip().split(Sep)
-				try:
-					TargetDict[TargetType].append(Target)
-				except KeyError:
-					if TargetType != "Type":
-						print(f"\nDetected {TargetType} not in type list, will be ignored")
-	print(f"\nThe input targets are:\n{TargetDict}\n")
-	return(TargetDict)
-
-
 ## ------------------------------------------------------------------------------------------------
 ## SCRIPT -----------------------------------------------------------------------------------------
 ## ------------------------------------------------------------------------------------------------
@@ -196,88 +234,115 @@ print('{:=^70}'.format('  VICINITY ANALYZER  '))
 print('{:=<70}'.format(''))
 print('{: ^70}\n\n'.format('2024, by A.L.O. Gaenssle'))
 
+if args.profile:
+	Profiler = Metrics.StartProfile()
+
+Analyzer = VA.VicinityAnalyzer(Range=args.range, ClusterSize=args.clustersize, 
+	FileType=args.filetype, Sep=args.separator, Ask=args.askoverwrite, Workers=args.workers, 
+	RequestRate=args.requestrate, KeggURL=args.keggurl, Retries=args.retries, 
+	Verify=not args.insecure, NeighborMode=args.neighbormode, 
+	Sequences=not args.nosequence, SequenceStore=args.sequencestore, UseCache=not args.nocache, CacheFile=args.cachefile, 
+	CacheAge=args.cacheage, CacheSize=args.cachesize, Offline=args.offline, 
+	CountWorkers=args.countworkers, PartitionRows=args.partitionrows, 
+	DensePositions=args.denseposition, 
+	TaxonomyFile=args.taxonomyfile)
 IE.CreateFolder(os.path.join(args.folder, "VicinityAnalysis"))
-OutputName =  os.path.join(args.folder, "VicinityAnalysis", args.name)
+
+# In batch mode, each input gets its own files (named after the input)
+if args.batch:
+	Inputs = VA.GetInputNames(VA.ReadBatch(args.input))
+	print(f"The batch contains {len(Inputs)} inputs: {', '.join(Inputs)}")
+else:
+	Inputs = {args.name: args.input}
 
 
 # Retrieve Sequence IDs from input, file or KEGG
+InputIDs = {}
 if any(s in ["i", "g"] for s in args.action):
-	OutputPath = os.path.join(args.folder, args.name)
-	if re.search(r"^K\d+$", args.input):
-		print("The input is a KO ID")
-		IDList, DataFrame = KEGG.DownloadOrthology(args.input)
-	elif os.path.exists(args.input):
-		print("The input is a file")
-		DataFrame = pd.read_csv(args.input, sep=args.separator, header=None)
-		IDList = DataFrame[DataFrame.columns[0]].to_list()
-	elif ":" in args.input:
-		print("The input is a (list of) gene ID(s)")
-		if "," in args.input:
-			IDList = args.input.split(",")
-		else:
-			IDList = [args.input]
-		DataFrame = pd.DataFrame(IDList, columns=["ID"])
-	else:
-		print("Please provide a valid input"
-			"\n- a KEGG Orthology (KO) ID (e.g. K22276)"
-			"\n- KEGG gene ID(s) (e.g. cak:Caul_3276,stax:MC45_14985)"
-			"\n- an existing file with gene IDs (.txt or .csv)")
-		quit()
-	if DataFrame.empty == False:
-		IE.ExportDataFrame(DataFrame, OutputPath, 
-			FileType=args.filetype, Sep=args.separator, Ask=args.askoverwrite)
-
+	for InputName, Input in Inputs.items():
+		OutputPath = os.path.join(args.folder, InputName)
+		try:
+			IDList, DataFrame = VA.RetrieveIDs(Input, args.separator, Analyzer.Session)
+		except ValueError as Error:
+			parser.error(str(Error))
+		except Cache_KEGG.OfflineError as Error:
+			sys.exit(str(Error))
+		InputIDs[InputName] = IDList
+		if DataFrame.empty == False:
+			IE.ExportDataFrame(DataFrame, OutputPath, 
+				FileType=args.filetype, Sep=args.separator, Ask=args.askoverwrite)
+
+
+# Sequences of all neighbors (shared by all inputs of a batch)
+if args.batch:
+	SequenceFile = os.path.join(args.folder, "VicinityAnalysis", args.name + "_Shared_Sequences")
+else:
+	SequenceFile = os.path.join(args.folder, "VicinityAnalysis", args.name + "_Sequences")
 
 # Get data from neighboring genes on KEGG
 if "g" in args.action:
-	OutputPath = OutputName + "_Neighbors"
-	FragmentFolder = IE.CreateFolder(OutputPath + "_Fragments")
-	FragmentFile = os.path.join(FragmentFolder, args.name + "_Neighbors")
-	Detailed = GetNeighbors(IDList, FragmentFile, args.range, 
-		args.filetype, args.separator, args.askoverwrite, args.clustersize)
-	IE.ExportDataFrame(Detailed, OutputPath, 
-		FileType=args.filetype, Sep=args.separator, Ask=args.askoverwrite)
-
-# Get 
-if "f" in args.action:
-	OutputPath = OutputName + "_Neighbors"
-	ProteinData = pd.read_csv(OutputPath + args.filetype, sep=args.separator)
-	ProteinData.drop(ProteinData.index[ProteinData["Status"] == "Error"], inplace = True)
-
-	# Set up dictionary of targets with Input:Type
-	TargetDict = GetTargets(args.targetID, args.targetDomain, args.targetName, 
+	if args.batch:
+
+		# Download the neighbors of all genes of all inputs together (each gene only once)
+		# -> sorted, so that genes of the same genome are in the same cluster
+		IDList = sorted(set(GeneID for IDList in InputIDs.values() for GeneID in IDList))
+		print(f"\n{len(IDList)} distinct genes in all inputs")
+		SharedPath = os.path.join(args.folder, "VicinityAnalysis", args.name + "_Shared_Neighbors")
+		FragmentFolder = IE.CreateFolder(SharedPath + "_Fragments")
+		FragmentFile = os.path.join(FragmentFolder, args.name + "_Shared_Neighbors")
+		try:
+			FragmentList = Analyzer.GetNeighbors(IDList, FragmentFile, None, args.retryerrors, 
+				SequenceFile)
+		except (ValueError, Cache_KEGG.OfflineError) as Error:
+			sys.exit(str(Error))
+
+		# Save the neighbors of each input in its own file
+		for InputName in Inputs:
+			OutputPath = os.path.join(args.folder, "VicinityAnalysis", InputName + "_Neighbors")
+			IE.CombineFiles(FragmentList, OutputPath, args.separator, args.filetype, 
+				args.askoverwrite, Refs=set(InputIDs[InputName]))
+	else:
+		OutputPath = os.path.join(args.folder, "VicinityAnalysis", args.name + "_Neighbors")
+		FragmentFolder = IE.CreateFolder(OutputPath + "_Fragments")
+		FragmentFile = os.path.join(FragmentFolder, args.name + "_Neighbors")
+		try:
+			Analyzer.GetNeighbors(IDList, FragmentFile, OutputPath, args.retryerrors, SequenceFile)
+		except (ValueError, Cache_KEGG.OfflineError) as Error:
+			sys.exit(str(Error))
+
+# Set up dictionary of targets with Input:Type
+if any(s in ["f", "s"] for s in args.action):
+	TargetDict = VA.GetTargets(args.targetID, args.targetDomain, args.targetName, 
 		args.targetFile, args.separator)
 
-	# Cycle through all target and add boolean column
-	TargetColumns = []
-	for TargetType in TargetDict:
-		for Target in TargetDict[TargetType]:
-			NewColumn = TargetType[:2] + "-" + Target
-			SearchColumn = TargetType
-			ProteinData[NewColumn] = ProteinData[SearchColumn].str.contains(Target)
-			TargetColumns.append(NewColumn)
-
-
-	# Count occcurences of each target at each range position
-	RangeCount = ProteinData.groupby('Pos')[TargetColumns] \
-		.apply(sum).reset_index()
-	print(f"\nFOUND TARGETS\n{RangeCount}\n\n")
-	IE.ExportDataFrame(RangeCount, OutputPath + "_RangeCount", 
-		FileType=args.filetype, Sep=args.separator, Ask=args.askoverwrite)
-
-	# Count occcurences of each target for each entry
-	EntryCount = ProteinData.copy().groupby('Ref')[TargetColumns] \
-		.apply(sum).reset_index()
-	IE.ExportDataFrame(EntryCount, OutputPath + "_EntryCount", 
-		FileType=args.filetype, Sep=args.separator, Ask=args.askoverwrite)
-
-	# Count occurences of each target type at each position and sum all in new columns
-	PositionCount = ProteinData[["Ref", "Pos"] + TargetColumns].copy()
-	PositionCount["SUM"] = PositionCount[TargetColumns].sum(axis=1).astype(int)
-	PositionCount = PositionCount.pivot(index="Ref", columns="Pos", values=TargetColumns+["SUM"]) \
-	.reset_index().fillna(False)
-	PositionCount.replace({False: 0, True: 1}, inplace=True)
-	IE.ExportDataFrame(PositionCount, OutputPath + "_PositionCount", 
-		FileType=args.filetype, Sep=args.separator, Ask=args.askoverwrite)
+# Count the targets in the neighbors of each input
+if "f" in args.action:
+	for InputName in Inputs:
+		OutputPath = os.path.join(args.folder, "VicinityAnalysis", InputName + "_Neighbors")
+		Fragments = None
+		if args.countfragments and not args.batch:
+			Fragments = VA.GetFragments(os.path.join(OutputPath + "_Fragments", 
+				InputName + "_Neighbors"))
+			if Fragments is None:
+				print("The fragments are not complete, count the combined neighbors file")
+		try:
+			Analyzer.CountNeighbors(OutputPath, TargetDict, Fragments, Levels)
+		except Cache_KEGG.OfflineError as Error:
+			sys.exit(str(Error))
+
+# Export the sequences of the neighbors with targets of each input
+if "s" in args.action:
+	for InputName in Inputs:
+		OutputPath = os.path.join(args.folder, "VicinityAnalysis", InputName + "_Neighbors")
+		Analyzer.ExportFasta(OutputPath, TargetDict, SequenceFile, args.sequencepos)
+
+# Close the connections to KEGG
+Analyzer.Close()
+
+# Save the metrics (and profile) of the run
+if args.profile:
+	Metrics.StopProfile(Profiler, os.path.join(args.folder, "VicinityAnalysis", 
+		args.name + "_Profile"))
+Metrics.WriteReport(args.metricsfile)
 
 print('{:=^70}'.format('  End of program  '))
\ No newline at end of file
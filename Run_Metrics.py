@@ -0,0 +1,161 @@
+#!/usr/bin/python
+# Written in Python 3.8 in 2023 by A.L.O. Gaenssle
+
+# MODULE: RUN METRICS
+# -> measures the time spent in each stage of a run (download, tables, export, counting, ...)
+# -> counts events of the run (requests, retries, bytes, cache hits, entries, errors per status)
+# -> shows the progress of the download with the estimated remaining time (ETA)
+# -> saves all metrics in a report (.json or .csv) and optionally profiles the run (cProfile)
+
+import os
+import io
+import csv
+import sys
+import json
+import time
+import pstats
+import cProfile
+import threading
+from contextlib import contextmanager
+
+Lock = threading.Lock()
+
+# Stage: [seconds, calls] (stages running in several threads at once are summed up)
+Timers = {}
+
+# Name: value
+Counters = {}
+
+Started = time.time()
+
+
+##-------------------------------------------------------------------------------------------------
+## METRIC FUNCTIONS -------------------------------------------------------------------------------
+##-------------------------------------------------------------------------------------------------
+## ================================================================================================
+## Remove all metrics (e.g. before a new run in the same program)
+def Reset():
+	global Started
+	with Lock:
+		Timers.clear()
+		Counters.clear()
+		Started = time.time()
+
+## ================================================================================================
+## Measure the time of a stage (with Stage("Export"): ...)
+@contextmanager
+def Stage(Name):
+	Start = time.perf_counter()
+	try:
+		yield
+	finally:
+		Duration = time.perf_counter() - Start
+		with Lock:
+			Timer = Timers.setdefault(Name, [0.0, 0])
+			Timer[0] += Duration
+			Timer[1] += 1
+
+## ================================================================================================
+## Add a value to a counter (e.g. Count("Requests") or Count("Bytes received", 1024))
+def Count(Name, Value=1):
+	with Lock:
+		Counters[Name] = Counters.get(Name, 0) + Value
+
+## ================================================================================================
+## Get all metrics of the run as a dict (Duration and stage times in seconds)
+def GetMetrics():
+	with Lock:
+		return({"Started": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(Started)),
+			"Duration": round(time.time() - Started, 3),
+			"Stages": {Name: {"Seconds": round(Seconds, 3), "Calls": Calls}
+				for Name, (Seconds, Calls) in Timers.items()},
+			"Counters": dict(Counters)})
+
+## ================================================================================================
+## Save the metrics as .json or .csv (one row per stage and counter: Type, Name, Value, Calls)
+def WriteReport(FileName):
+	Metrics = GetMetrics()
+	Folder = os.path.dirname(FileName)
+	if Folder and not os.path.exists(Folder):
+		os.makedirs(Folder)
+	with open(FileName, "w", newline="") as File:
+		if FileName.endswith(".csv"):
+			Writer = csv.writer(File)
+			Writer.writerow(["Type", "Name", "Value", "Calls"])
+			Writer.writerow(["Run", "Duration", Metrics["Duration"], ""])
+			for Name, Timer in Metrics["Stages"].items():
+				Writer.writerow(["Stage", Name, Timer["Seconds"], Timer["Calls"]])
+			for Name, Value in Metrics["Counters"].items():
+				Writer.writerow(["Counter", Name, Value, ""])
+		else:
+			json.dump(Metrics, File, indent=2)
+	print(f"Metrics saved as: {FileName}")
+	return(Metrics)
+
+
+##-------------------------------------------------------------------------------------------------
+## PROGRESS ---------------------------------------------------------------------------------------
+##-------------------------------------------------------------------------------------------------
+## ================================================================================================
+## Progress bar of a number of items with the estimated remaining time
+## -> one line is printed per update (so that it is not mixed up with other output)
+## -> items that are skipped (e.g. already downloaded) do not count for the ETA
+class Progress:
+	def __init__(self, Total, Unit="genes", Width=30, Stream=None):
+		self.Total = Total
+		self.Unit = Unit
+		self.Width = Width
+		self.Stream = Stream
+		self.Done = 0
+		self.Skipped = 0
+		self.Start = time.monotonic()
+		self.Lock = threading.Lock()
+
+	def Skip(self, Items):
+		with self.Lock:
+			self.Done += Items
+			self.Skipped += Items
+
+	def Update(self, Items=1):
+		with self.Lock:
+			self.Done += Items
+			print(self.Format(), file=self.Stream or sys.stdout)
+
+	def Format(self):
+		Elapsed = time.monotonic() - self.Start
+		Share = self.Done / self.Total if self.Total else 1.0
+		Filled = int(round(Share * self.Width))
+		Line = (f"[{'#' * Filled}{'-' * (self.Width - Filled)}] {Share:>4.0%} "
+			f"{self.Done}/{self.Total} {self.Unit}, {FormatTime(Elapsed)} elapsed")
+		Measured = self.Done - self.Skipped
+		if 0 < Measured and self.Done < self.Total:
+			Line += f", ETA {FormatTime(Elapsed / Measured * (self.Total - self.Done))}"
+		return(Line)
+
+## ================================================================================================
+def FormatTime(Seconds):
+	Minutes, Seconds = divmod(int(Seconds), 60)
+	Hours, Minutes = divmod(Minutes, 60)
+	return(f"{Hours}:{Minutes:02d}:{Seconds:02d}")
+
+
+##-------------------------------------------------------------------------------------------------
+## PROFILING --------------------------------------------------------------------------------------
+##-------------------------------------------------------------------------------------------------
+## ================================================================================================
+## Profile the run with cProfile (only the thread that starts it, i.e. downloads with Workers=1)
+def StartProfile():
+	Profiler = cProfile.Profile()
+	Profiler.enable()
+	return(Profiler)
+
+## ================================================================================================
+## Save the profile (FileName.prof for pstats/snakeviz) and the slowest functions (FileName.txt)
+def StopProfile(Profiler, FileName, Lines=40):
+	Profiler.disable()
+	Profiler.dump_stats(FileName + ".prof")
+	Text = io.StringIO()
+	pstats.Stats(Profiler, stream=Text).sort_stats("cumulative").print_stats(Lines)
+	with open(FileName + ".txt", "w") as File:
+		File.write(Text.getvalue())
+	print(f"Profile saved as: {FileName}.prof and {FileName}.txt")
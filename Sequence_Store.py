@@ -0,0 +1,181 @@
+#!/usr/bin/python
+# Written in Python 3.8 in 2023 by A.L.O. Gaenssle
+
+# MODULE: SEQUENCE STORE
+# -> keeps the sequences of the neighbors in an indexed FASTA file instead of the tables
+# -> the index (.fai, as samtools faidx) saves the position of each sequence by gene ID
+# -> sequences are read by random access (only the requested sequences are read)
+# -> sequences are appended, each gene ID is only saved once
+
+import os
+
+# Residues per line of the FASTA file
+LineWidth = 60
+
+
+##-------------------------------------------------------------------------------------------------
+## STORE CLASS ------------------------------------------------------------------------------------
+##-------------------------------------------------------------------------------------------------
+## ================================================================================================
+## Indexed FASTA file of sequences (FilePath without .fasta)
+## -> the new index lines are appended after each Add, sequences written after the last index line
+##    are removed when the store is opened again (e.g. after a crash)
+## -> without index file, the index is rebuilt from the FASTA file
+## -> ReadOnly: the files are neither created nor changed (e.g. for the export)
+class SequenceStore:
+	def __init__(self, FilePath, ReadOnly=False):
+		self.FileName = FilePath + ".fasta"
+		self.IndexName = self.FileName + ".fai"
+		self.ReadOnly = ReadOnly
+
+		# GeneID: (length, offset of the sequence, residues per line, bytes per line)
+		self.Index = {}
+		if os.path.exists(self.IndexName):
+			self.Index, IndexEnd = ReadIndex(self.IndexName)
+			End = max((GetEnd(*Entry) for Entry in self.Index.values()), default=0)
+			if not ReadOnly:
+				Truncate(self.IndexName, IndexEnd)
+				Truncate(self.FileName, End)
+		elif os.path.exists(self.FileName):
+			self.Index, End = ScanFasta(self.FileName)
+			if not ReadOnly:
+				Truncate(self.FileName, End)
+				WriteIndex(self.IndexName, self.Index, "w")
+		if not ReadOnly:
+			Folder = os.path.dirname(self.FileName)
+			if Folder and not os.path.exists(Folder):
+				os.makedirs(Folder)
+			open(self.FileName, "ab").close()
+
+	def __contains__(self, GeneID):
+		return(GeneID in self.Index)
+
+	def __len__(self):
+		return(len(self.Index))
+
+	## --------------------------------------------------------------------------------------------
+	## Add sequences (dict of GeneID: Sequence), gene IDs already in the store are skipped
+	def Add(self, Sequences):
+		if self.ReadOnly:
+			raise PermissionError(f"The sequence store {self.FileName} is opened read-only")
+		New = {GeneID: Sequence for GeneID, Sequence in Sequences.items()
+			if Sequence and GeneID not in self.Index}
+		if not New:
+			return(0)
+		Index = {}
+		with open(self.FileName, "ab") as File:
+			Offset = File.tell()
+			for GeneID, Sequence in New.items():
+				Header = (">" + GeneID + "\n").encode()
+				Lines = "".join(Sequence[x:x+LineWidth] + "\n"
+					for x in range(0, len(Sequence), LineWidth)).encode()
+				File.write(Header + Lines)
+				Index[GeneID] = (len(Sequence), Offset + len(Header), LineWidth, LineWidth + 1)
+				Offset += len(Header) + len(Lines)
+			File.flush()
+			os.fsync(File.fileno())
+		self.Index.update(Index)
+		WriteIndex(self.IndexName, Index, "a")
+		return(len(New))
+
+	## --------------------------------------------------------------------------------------------
+	## Read the sequences of the gene IDs -> dict of GeneID: Sequence (missing IDs are skipped)
+	## -> sequences are read in the order of the file
+	def Get(self, GeneIDs):
+		Found = sorted((self.Index[GeneID][1], GeneID) for GeneID in set(GeneIDs)
+			if GeneID in self.Index)
+		Sequences = {}
+		if not Found:
+			return(Sequences)
+		with open(self.FileName, "rb") as File:
+			for Offset, GeneID in Found:
+				Length, Offset, LineBases, LineBytes = self.Index[GeneID]
+				File.seek(Offset)
+				Data = File.read(GetEnd(Length, Offset, LineBases, LineBytes) - Offset)
+				Sequences[GeneID] = Data.decode().replace("\n", "")
+		return(Sequences)
+
+
+## ================================================================================================
+## Get the end (file position) of a sequence from its index entry
+def GetEnd(Length, Offset, LineBases, LineBytes):
+	return(Offset + Length // LineBases * LineBytes + (Length % LineBases + 1 if Length % LineBases
+		else 0))
+
+## ================================================================================================
+## Read the index file -> dict of GeneID: index entry, end of the last complete line
+## -> a line without line break (e.g. after a crash) is left out
+def ReadIndex(FileName):
+	Index = {}
+	End = 0
+	with open(FileName, "rb") as File:
+		for Line in File:
+			if not Line.endswith(b"\n"):
+				break
+			End += len(Line)
+			Columns = Line.decode().rstrip("\n").split("\t")
+			if len(Columns) == 5:
+				Index[Columns[0]] = tuple(int(Value) for Value in Columns[1:])
+	return(Index, End)
+
+## ================================================================================================
+## Append (Mode="a") or write (Mode="w") index lines (dict of GeneID: index entry)
+def WriteIndex(FileName, Index, Mode):
+	with open(FileName, Mode) as File:
+		File.write("".join(GeneID + "\t" + "\t".join(str(Value) for Value in Entry) + "\n"
+			for GeneID, Entry in Index.items()))
+
+## ================================================================================================
+## Build the index from the FASTA file -> dict of GeneID: index entry, end of the last sequence
+## -> the last sequence is left out if its last line has no line break (e.g. after a crash)
+def ScanFasta(FileName):
+	Index = {}
+	End = 0
+	GeneID = None
+	with open(FileName, "rb") as File:
+		Offset = Start = 0
+		for Line in File:
+			if not Line.endswith(b"\n"):
+				if GeneID is not None:
+					del Index[GeneID]
+					End = Start
+				break
+			Offset += len(Line)
+			if Line.startswith(b">"):
+				Start = Offset - len(Line)
+				GeneID = Line[1:].split()[0].decode() if Line[1:].strip() else None
+				if GeneID is not None:
+					Index[GeneID] = [0, Offset, 0, 0]
+			elif GeneID is not None:
+				Entry = Index[GeneID]
+				if not Entry[2]:
+					Entry[2], Entry[3] = len(Line) - 1, len(Line)
+				Entry[0] += len(Line) - 1
+			End = Offset
+	return({GeneID: tuple(Entry) for GeneID, Entry in Index.items() if Entry[0]}, End)
+
+## ================================================================================================
+## Cut a file after End bytes (only if it is longer)
+def Truncate(FileName, End):
+	if os.path.exists(FileName) and os.path.getsize(FileName) > End:
+		with open(FileName, "r+b") as File:
+			File.truncate(End)
+
+
+##-------------------------------------------------------------------------------------------------
+## FASTA FUNCTIONS --------------------------------------------------------------------------------
+##-------------------------------------------------------------------------------------------------
+## ================================================================================================
+## Write sequences to a FASTA file (Sequences: dict of GeneID: Sequence)
+## -> Descriptions (optional): dict of GeneID: text added to the header line
+def WriteFasta(FileName, Sequences, Descriptions=None):
+	with open(FileName + ".tmp", "w") as File:
+		for GeneID, Sequence in Sequences.items():
+			Header = ">" + GeneID
+			if Descriptions and Descriptions.get(GeneID):
+				Header += " " + Descriptions[GeneID]
+			File.write(Header + "\n" + "".join(Sequence[x:x+LineWidth] + "\n"
+				for x in range(0, len(Sequence), LineWidth)))
+	os.replace(FileName + ".tmp", FileName)
+	print("File saved as:", FileName, "\n")
+	return(FileName)
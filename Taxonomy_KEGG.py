@@ -0,0 +1,110 @@
+#!/usr/bin/python
+# Written in Python 3.8 in 2023 by A.L.O. Gaenssle
+
+# MODULE: TAXONOMY INDEX OF KEGG ORGANISMS
+# -> keeps the lineage (Kingdom, Phylum, Class, Order) of all organisms on KEGG by orgID
+# -> saved as pickled index in a local file, downloaded again only if older than the set days
+# -> returns the lineage of an organism or one level of all organisms as lookup (dict)
+
+import os
+import sys
+import time
+import pickle
+
+# Increase to invalidate the index files of older versions (e.g. if the parser changes)
+Version = 1
+
+# Levels of the lineage in the KEGG list of organisms
+Levels = ("Kingdom", "Phylum", "Class", "Order")
+
+# Index shared by all runs of the user (next to the cache of KEGG entries)
+DefaultFile = os.path.join(os.path.expanduser("~"), ".VicinityAnalyzer", "KEGG_Taxonomy.pickle")
+
+
+##-------------------------------------------------------------------------------------------------
+## INDEX CLASS ------------------------------------------------------------------------------------
+##-------------------------------------------------------------------------------------------------
+## ================================================================================================
+## Lineage of all organisms (dict of orgID: (Kingdom, Phylum, Class, Order), None if not given)
+## -> Created: time of the download (seconds since epoch)
+class TaxonomyIndex:
+	def __init__(self, Lineages, Created=None):
+		self.Lineages = Lineages
+		self.Created = time.time() if Created is None else Created
+		self.LevelLookups = {}
+
+	def __len__(self):
+		return(len(self.Lineages))
+
+	def __contains__(self, orgID):
+		return(orgID in self.Lineages)
+
+	## --------------------------------------------------------------------------------------------
+	## Get the lineage of an organism as dict of Level: name (None if the organism is not known)
+	def Get(self, orgID):
+		Lineage = self.Lineages.get(orgID)
+		if Lineage is None:
+			return(None)
+		return(dict(zip(Levels, Lineage)))
+
+	## --------------------------------------------------------------------------------------------
+	## Get one level of all organisms as dict of orgID: name (e.g. for pandas Series.map)
+	## -> Level="Taxonomy" returns Kingdom-Phylum (as the Taxonomy column of the neighbors)
+	def GetLevel(self, Level):
+		if Level not in self.LevelLookups:
+			if Level == "Taxonomy":
+				Lookup = {orgID: sys.intern(Lineage[0] + "-" + Lineage[1])
+					for orgID, Lineage in self.Lineages.items() if Lineage[0] and Lineage[1]}
+			else:
+				Index = Levels.index(Level)
+				Lookup = {orgID: Lineage[Index] for orgID, Lineage in self.Lineages.items()
+					if Lineage[Index] is not None}
+			self.LevelLookups[Level] = Lookup
+		return(self.LevelLookups[Level])
+
+	## --------------------------------------------------------------------------------------------
+	## Check if the index is older than MaxAge days
+	def IsStale(self, MaxAge):
+		return(time.time() - self.Created > MaxAge * 86400)
+
+	## --------------------------------------------------------------------------------------------
+	## Save the index (written under a temporary name and then renamed)
+	def Save(self, FileName):
+		Folder = os.path.dirname(FileName)
+		if Folder and not os.path.exists(Folder):
+			os.makedirs(Folder)
+		with open(FileName + ".tmp", "wb") as File:
+			pickle.dump({"Version": Version, "Created": self.Created, "Lineages": self.Lineages},
+				File, protocol=pickle.HIGHEST_PROTOCOL)
+		os.replace(FileName + ".tmp", FileName)
+
+	## --------------------------------------------------------------------------------------------
+	## Load a saved index (None if the file does not exist, is damaged or of another version)
+	@classmethod
+	def Load(cls, FileName):
+		if not os.path.exists(FileName):
+			return(None)
+		try:
+			with open(FileName, "rb") as File:
+				Data = pickle.load(File)
+		except (OSError, EOFError, pickle.UnpicklingError):
+			return(None)
+		if not isinstance(Data, dict) or Data.get("Version") != Version:
+			return(None)
+		return(cls(Data["Lineages"], Data["Created"]))
+
+
+##-------------------------------------------------------------------------------------------------
+## PARSER -----------------------------------------------------------------------------------------
+##-------------------------------------------------------------------------------------------------
+## ================================================================================================
+## Read the KEGG list of organisms (T number, orgID, name, lineage separated by ;) -> index
+def ParseOrganismList(Text):
+	Lineages = {}
+	for Line in Text.split("\n"):
+		Columns = Line.split("\t")
+		if len(Columns) < 4:
+			continue
+		Lineage = [sys.intern(Name) for Name in Columns[3].strip().split(";") if Name][:len(Levels)]
+		Lineages[sys.intern(Columns[1])] = tuple(Lineage + [None] * (len(Levels) - len(Lineage)))
+	return(TaxonomyIndex(Lineages))
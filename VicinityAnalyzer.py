@@ -0,0 +1,723 @@
+#!/usr/bin/python
+# Written in Python 3.8 in 2023 by A.L.O. Gaenssle
+
+# MODULE: VICINITY ANALYZER (importable without the command line interface of Main.py)
+# -> retrieves gene IDs from a KO ID, a file or a list of gene IDs
+# -> downloads the neighbors of all genes (in fragment files or as dataframes per cluster)
+# -> counts the occurrences of targets in the neighbors (optionally in partitions in several processes)
+# -> counts the targets per taxon of the reference genes (e.g. per phylum at each position)
+# -> saves the sequences in an indexed FASTA file (optional) and exports the sequences of hits
+# -> never asks for input, invalid inputs raise a ValueError
+
+import os
+import re
+import hashlib
+import multiprocessing
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+# Own modules
+import Import_Export as IE
+import Download_KEGG as KEGG
+import Cache_KEGG
+import Taxonomy_KEGG
+import Filter_Targets as FT
+import Run_Metrics as Metrics
+import Sequence_Store as SS
+
+
+## ------------------------------------------------------------------------------------------------
+## MAIN FUNCTIONS ---------------------------------------------------------------------------------
+## ------------------------------------------------------------------------------------------------
+## ================================================================================================
+## Get index list of neighbors and retrieves protein data
+## -> the sequences are saved in the sequence store (SequenceFile without .fasta) if given
+##    instead of the fragments
+## -> downloads with the connection, cache and taxonomy of the Session (Download_KEGG.KeggSession)
+def GetNeighbors(IDList, FilePath, OutputPath, Range, FileType, Sep, Ask, ClusterSize, Workers=1, 
+	UseOrder=True, Fields=None, RetryErrors=False, SequenceFile=None, Session=None):
+	Taxonomy = None
+	Store = SS.SequenceStore(SequenceFile) if SequenceFile else None
+	print("Download protein data for", len(IDList), "IDs . . .")
+
+	# Create clusters of sequences to generate smaller files (in case the download crashes)
+	ClusteredList = [IDList[x:x+ClusterSize] for x in range(0, len(IDList), ClusterSize)]
+	FragmentList = [FilePath + "_" + str(ClusterID+1) + FileType 
+		for ClusterID in range(len(ClusteredList))]
+
+	# Save which fragments belong to this download (fragments of other runs are not combined)
+	# -> with a larger range, only the missing positions of the existing fragments are downloaded
+	#    (the range of the manifest is raised when all fragments have been expanded)
+	# -> the range of each saved fragment and the locus tag steps (>1) of its genes are kept
+	# -> fragments of other genes or another cluster size are not reused (e.g. a changed batch)
+	ManifestFile = FilePath + "_Manifest.json"
+	Manifest = IE.ReadManifest(ManifestFile)
+	IDHash = hashlib.sha1("\n".join(IDList).encode()).hexdigest()
+	OldRange = Range
+	Saved = {"FragmentRanges": {}, "Steps": {}}
+	if Manifest is not None:
+		if any(Key not in Manifest for Key in IE.ManifestFields):
+			raise ValueError(f"The manifest of the existing fragments of {FilePath} is incomplete "
+				"(e.g. written by another version), remove them or use another name")
+		if not CheckFragments(Manifest, IDHash, ClusterSize):
+			raise ValueError(f"The existing fragments of {FilePath} were downloaded for other "
+				f"genes or another cluster size (clustersize={Manifest['ClusterSize']}, "
+				f"genes={Manifest['Genes']}), remove them or use another name")
+		Saved = {Key: Manifest[Key] for Key in Saved}
+		OldRange = Manifest["Range"]
+		if OldRange < Range:
+			print(f"The existing fragments are expanded from range {OldRange} to {Range}\n")
+		elif OldRange > Range:
+			print(f"Warning: the existing fragments were downloaded with range {OldRange}\n")
+	Manifest = {"Range": min(OldRange, Range), "ClusterSize": ClusterSize, 
+		"Genes": len(IDList), "IDHash": IDHash, 
+		"Fragments": [os.path.basename(File) for File in FragmentList], **Saved}
+	IE.WriteManifest(ManifestFile, Manifest)
+
+	# Each finished gene is saved in the journal (genes of unfinished clusters are not lost)
+	# -> with the range and step it was searched with
+	# -> the genes of a saved fragment are removed from the journal (their steps are kept in the
+	#    manifest), the sequences are saved in the sequence store instead of the journal
+	# The progress is updated with each finished gene (genes loaded from files are skipped)
+	JournalFile = FilePath + "_Journal.jsonl"
+	Journal = IE.ReadJournal(JournalFile)
+	Steps = dict(Manifest["Steps"])
+	Steps.update({GeneID: Gene["Step"] for GeneID, Gene in Journal.items() 
+		if Gene["Step"] is not None})
+	Progress = Metrics.Progress(len(IDList))
+	def SaveJournal(Genes):
+		WriteJournal(JournalFile, Genes, Range, Steps, Store)
+		Progress.Update(len(Genes))
+	def GetFragmentRange(FragmentFile):
+		return(Manifest["FragmentRanges"].get(os.path.basename(FragmentFile), OldRange))
+	def SaveFragment(FragmentFile, GeneIDs, FragmentRange):
+		Manifest["FragmentRanges"][os.path.basename(FragmentFile)] = FragmentRange
+		Manifest["Steps"].update({GeneID: Steps[GeneID] for GeneID in GeneIDs 
+			if Steps.get(GeneID, 1) > 1})
+		IE.WriteManifest(ManifestFile, Manifest)
+		IE.CompactJournal(JournalFile, GeneIDs)
+		for GeneID in GeneIDs:
+			Journal.pop(GeneID, None)
+
+	for ClusterID in range(len(ClusteredList)):
+		print("Download cluster", ClusterID+1, "of", len(ClusteredList))
+		FragmentFile = FilePath + "_" + str(ClusterID+1)
+		Cluster = ClusteredList[ClusterID]
+		print(FragmentFile)
+
+		# Ignore all files that have already been downloaded (with the range or a larger one)
+		# -> genes left in the journal (e.g. after a crash) are removed
+		# -> the genes of fragments with a smaller range are expanded by the missing positions
+		#    (the neighbors of the journal are used as well)
+		if os.path.exists(FragmentFile + FileType):
+			FragmentRange = GetFragmentRange(FragmentFile)
+			if FragmentRange >= Range:
+				Progress.Skip(len(Cluster))
+				print("File already exists, skip to next cluster\n")
+				if any(GeneID in Journal for GeneID in Cluster):
+					SaveFragment(FragmentFile, Cluster, FragmentRange)
+				continue
+			if Taxonomy is None:
+				with Metrics.Stage("Organisms"):
+					Taxonomy = KEGG.DownloadTaxonomy(Session)
+			Known = GetKnownProteins(Row for GeneID in Cluster if GeneID in Journal 
+				for Row in Journal[GeneID]["Neighbors"])
+			ExpandFragment(FragmentFile + FileType, list(dict.fromkeys(Cluster)), Range, FileType, 
+				Sep, Taxonomy, Workers, UseOrder, Fields, SaveJournal, Steps, Store, Known, Session)
+			SaveFragment(FragmentFile, Cluster, Range)
+
+		# Download all files that have not yet been saved (except genes in the journal)
+		# -> genes of the journal with a smaller range are expanded by the missing positions
+		else:
+			Missing = [GeneID for GeneID in Cluster 
+				if GeneID not in Journal or Journal[GeneID]["Range"] < Range]
+			if len(Missing) < len(Cluster):
+				print(f"Load {len(Cluster) - len(Missing)} genes from the journal")
+				Progress.Skip(len(Cluster) - len(Missing))
+			Genes = {GeneID: [KEGG.Neighbor.FromDict(Row) for Row in Journal[GeneID]["Neighbors"]] 
+				for GeneID in Cluster if GeneID not in Missing}
+			if Missing:
+				Known = GetKnownProteins(Row for GeneID in Missing if GeneID in Journal 
+					for Row in Journal[GeneID]["Neighbors"])
+				Neighbors = KEGG.DownloadCluster(Missing, Range, Workers, UseOrder, Fields, 
+					SaveJournal, Known, Steps, Session)
+				for Protein in Neighbors:
+					Genes.setdefault(Protein.Ref, []).append(Protein)
+			Neighbors = [Protein for GeneID in dict.fromkeys(Cluster) 
+				for Protein in Genes.get(GeneID, [])]
+
+			# Only download the list of organisms on KEGG if needed and add to dataframe
+			if Taxonomy is None:
+				with Metrics.Stage("Organisms"):
+					Taxonomy = KEGG.DownloadTaxonomy(Session)
+			with Metrics.Stage("Build tables"):
+				ProteinTable = BuildFragment(Neighbors, Taxonomy, Store)
+			with Metrics.Stage("Export fragments"):
+				IE.ExportDataFrame(ProteinTable, FragmentFile, FileType=FileType, Sep=Sep, Ask=Ask)
+			SaveFragment(FragmentFile, Cluster, Range)
+			StatusCount = ProteinTable.groupby('Ref').first().reset_index()
+			StatusCount = StatusCount.groupby(["Status"], observed=True).size()
+			print(f"Done!\n->Neighbors found: {len(ClusteredList[ClusterID])} searched",
+				f"\n{StatusCount.to_string()}\n")
+	if Manifest["Range"] != Range:
+		Manifest["Range"] = Range
+		IE.WriteManifest(ManifestFile, Manifest)
+
+	# Download genes with errors or incomplete neighbors again and replace them in the fragments
+	if RetryErrors:
+		for FragmentFile, Cluster in zip(FragmentList, ClusteredList):
+			if Taxonomy is None:
+				with Metrics.Stage("Organisms"):
+					Taxonomy = KEGG.DownloadTaxonomy(Session)
+			RetryFragment(FragmentFile, Range, FileType, Sep, Taxonomy, Workers, UseOrder, 
+				Fields, lambda Genes: WriteJournal(JournalFile, Genes, Range, Steps, Store), Store, 
+				Steps, Session)
+			FragmentFile = FragmentFile[:-len(FileType)]
+			SaveFragment(FragmentFile, Cluster, GetFragmentRange(FragmentFile))
+
+	# After all entries have been downloaded, combine all fragments into one file
+	if OutputPath is None:
+		return(FragmentList)
+	with Metrics.Stage("Combine files"):
+		return(IE.CombineFiles(FragmentList, OutputPath, Sep, FileType, Ask))
+
+
+## ================================================================================================
+## Check if the fragments of a manifest were downloaded for the same clusters of genes
+## -> compares the cluster size and the hash of the gene IDs
+def CheckFragments(Manifest, IDHash, ClusterSize):
+	return(Manifest["ClusterSize"] == ClusterSize and Manifest["IDHash"] == IDHash)
+
+
+## ================================================================================================
+## Create the table of neighbors (Download_KEGG.Neighbor) column by column
+## -> the taxonomy of each organism is looked up in the dict of orgID: Taxonomy
+## -> columns with few distinct values (orgID, KO-ID, Status, Taxonomy) are saved as categories
+## -> the sequences are added to the sequence store (if given) instead of the table
+def BuildFragment(Neighbors, Taxonomy, Store=None):
+	Proteins = [Neighbor.Protein for Neighbor in Neighbors]
+	Keys = ["Ref"]
+	Seen = {}
+	for Protein in Proteins:
+		if Protein is not None and id(Protein) not in Seen:
+			Seen[id(Protein)] = Protein
+			Keys.extend(Key for Key in Protein if Key not in Keys)
+	if Store is not None and "Sequence" in Keys:
+		Keys.remove("Sequence")
+		with Metrics.Stage("Save sequences"):
+			Store.Add({Protein["ID"]: Protein["Sequence"] for Protein in Seen.values() 
+				if Protein.get("Sequence")})
+	Columns = {"Ref": [Neighbor.Ref for Neighbor in Neighbors]}
+	for Key in Keys[1:]:
+		Columns[Key] = [Protein.get(Key) if Protein is not None else None for Protein in Proteins]
+	if len(Keys) > 1:
+		Columns["Pos"] = [Neighbor.Pos for Neighbor in Neighbors]
+	Columns["Status"] = [Neighbor.Status for Neighbor in Neighbors]
+	if "orgID" in Columns:
+		Columns["Taxonomy"] = [Taxonomy.get(orgID) for orgID in Columns["orgID"]]
+	ProteinTable = pd.DataFrame(Columns)
+	for Column in ["orgID", "KO-ID", "Status", "Taxonomy"]:
+		if Column in ProteinTable.columns:
+			ProteinTable[Column] = ProteinTable[Column].astype("category")
+	return(ProteinTable)
+
+
+## ================================================================================================
+## Save finished genes (list of (GeneID, neighbors)) in the journal as rows of the neighbors table
+## -> with the range and the step of the locus tags of each gene (dict of GeneID:step)
+## -> the sequences are saved in the sequence store (if given) instead of the rows
+def WriteJournal(JournalFile, Genes, Range, Steps=None, Store=None):
+	Genes = [(GeneID, [Neighbor.ToDict() for Neighbor in Neighbors]) for GeneID, Neighbors in Genes]
+	if Store is not None:
+		Sequences = {}
+		for GeneID, Rows in Genes:
+			for Row in Rows:
+				Sequence = Row.pop("Sequence", None)
+				if Sequence and Row.get("ID"):
+					Sequences[Row["ID"]] = Sequence
+		with Metrics.Stage("Save sequences"):
+			Store.Add(Sequences)
+	IE.AppendJournal(JournalFile, Genes, Range, Steps)
+
+
+## ================================================================================================
+## Get the proteins of neighbors that are already known (rows of the neighbors table or journal)
+## -> returns dict of ID:protein (rows without ID, i.e. genes with errors, are skipped)
+def GetKnownProteins(Rows):
+	Known = {}
+	for Row in Rows:
+		Protein = {Key: Value for Key, Value in Row.items() 
+			if Key not in ("Ref", "Pos", "Status", "Taxonomy") and not pd.isna(Value)}
+		if Protein.get("ID"):
+			Known[Protein["ID"]] = Protein
+	return(Known)
+
+
+## ================================================================================================
+## Replace the rows of genes in a fragment by a new table (same order of genes) and save it
+def ReplaceGenes(ProteinTable, GeneIDs, NewTable, FragmentFile, FileType, Sep):
+	Order = {GeneID: Index for Index, GeneID in enumerate(dict.fromkeys(ProteinTable["Ref"]))}
+	Columns = list(dict.fromkeys(list(NewTable.columns) + list(ProteinTable.columns)))
+	ProteinTable = pd.concat([ProteinTable[~ProteinTable["Ref"].isin(GeneIDs)], NewTable], 
+		ignore_index=True)[Columns]
+	ProteinTable = ProteinTable.sort_values("Ref", key=lambda Column: Column.map(Order), 
+		kind="stable")
+	IE.ExportDataFrame(ProteinTable, FragmentFile[:-len(FileType)], FileType=FileType, Sep=Sep, 
+		Ask=False)
+	StatusCount = ProteinTable.groupby('Ref').first().reset_index()
+	print(f"{StatusCount.groupby(['Status'], observed=True).size().to_string()}\n")
+
+
+## ================================================================================================
+## Download all genes of a fragment with status Error or Incomplete again and replace them
+def RetryFragment(FragmentFile, Range, FileType, Sep, Taxonomy, Workers, UseOrder, Fields, 
+	SaveJournal, Store=None, Steps=None, Session=None):
+	ProteinTable = IE.ImportDataFrame(FragmentFile, Sep)
+	Retry = ProteinTable.loc[ProteinTable["Status"].isin(["Error", "Incomplete"]), "Ref"] \
+		.unique().tolist()
+	if not Retry:
+		return
+	print(f"Download {len(Retry)} genes with errors or incomplete neighbors of {FragmentFile}")
+	Neighbors = KEGG.DownloadCluster(Retry, Range, Workers, UseOrder, Fields, SaveJournal, 
+		Steps=Steps, Session=Session)
+	ReplaceGenes(ProteinTable, Retry, BuildFragment(Neighbors, Taxonomy, Store), FragmentFile, 
+		FileType, Sep)
+
+
+## ================================================================================================
+## Expand the genes of a fragment (downloaded with a smaller range) to the range
+## -> the neighbors in the fragment are kept, only the missing (outer) positions are downloaded
+## -> the locus tags are searched with the step found before (dict of GeneID:step)
+## -> Known (optional): dict of ID:protein of other neighbors already downloaded (e.g. journal)
+def ExpandFragment(FragmentFile, GeneIDs, Range, FileType, Sep, Taxonomy, Workers, UseOrder, 
+	Fields, SaveJournal, Steps=None, Store=None, Known=None, Session=None):
+	ProteinTable = IE.ImportDataFrame(FragmentFile, Sep)
+	Known = dict(Known) if Known else {}
+	Known.update(GetKnownProteins(ProteinTable[ProteinTable["Ref"].isin(GeneIDs)] \
+		.to_dict("records")))
+	print(f"Download the missing positions of {len(GeneIDs)} genes of {FragmentFile} "
+		f"(range {Range})")
+	Metrics.Count("Genes expanded", len(GeneIDs))
+	Neighbors = KEGG.DownloadCluster(GeneIDs, Range, Workers, UseOrder, Fields, SaveJournal, 
+		Known, Steps, Session)
+	with Metrics.Stage("Build tables"):
+		NewTable = BuildFragment(Neighbors, Taxonomy, Store)
+	with Metrics.Stage("Export fragments"):
+		ReplaceGenes(ProteinTable, GeneIDs, NewTable, FragmentFile, FileType, Sep)
+
+
+## ================================================================================================
+## Get the list of gene IDs from a KO ID (download from KEGG), a file or a list of gene IDs
+def RetrieveIDs(Input, Sep, Session=None):
+	if re.search(r"^K\d+$", Input):
+		print("The input is a KO ID")
+		with Metrics.Stage("Retrieve IDs"):
+			IDList, DataFrame = KEGG.DownloadOrthology(Input, Session)
+	elif os.path.exists(Input):
+		print("The input is a file")
+		DataFrame = pd.read_csv(Input, sep=Sep, header=None)
+		IDList = DataFrame[DataFrame.columns[0]].to_list()
+	elif ":" in Input:
+		print("The input is a (list of) gene ID(s)")
+		if "," in Input:
+			IDList = Input.split(",")
+		else:
+			IDList = [Input]
+		DataFrame = pd.DataFrame(IDList, columns=["ID"])
+	else:
+		raise ValueError("Please provide a valid input"
+			"\n- a KEGG Orthology (KO) ID (e.g. K22276)"
+			"\n- KEGG gene ID(s) (e.g. cak:Caul_3276,stax:MC45_14985)"
+			"\n- an existing file with gene IDs (.txt or .csv)")
+	return(IDList, DataFrame)
+
+
+## ================================================================================================
+## Get the list of inputs of a batch (file with one input per line or comma-separated inputs)
+def ReadBatch(Batch):
+	if os.path.isfile(Batch):
+		with open(Batch) as File:
+			return([Line.strip() for Line in File if Line.strip()])
+	return([Input.strip() for Input in Batch.split(",") if Input.strip()])
+
+
+## ================================================================================================
+## Get a file name for each input of a batch (KO ID, file name or gene IDs)
+def GetInputName(Input):
+	if os.path.isfile(Input):
+		Input = os.path.split(Input)[1].rsplit(".",1)[0]
+	return(re.sub(r"[^\w.-]+", "_", Input)[:60])
+
+## ================================================================================================
+## Get a unique file name for each input of a batch -> dict of name:input
+## -> inputs with the same name (e.g. cut after 60 characters) get a number (_2, _3, ...)
+def GetInputNames(Inputs):
+	Names = {}
+	for Input in dict.fromkeys(Inputs):
+		Name = NewName = GetInputName(Input)
+		Number = 1
+		while NewName in Names:
+			Number += 1
+			NewName = f"{Name}_{Number}"
+		if NewName != Name:
+			print(f"The input {Input} is saved as {NewName} ({Name} is used by {Names[Name]})")
+		Names[NewName] = Input
+	return(Names)
+
+
+## ================================================================================================
+## Count the targets in the neighbors file and export the count files (returns the counts)
+## -> the counted targets are saved with the state of the neighbors file (_CountInfo.json)
+## -> if the neighbors file did not change, only new targets are matched and counted and added 
+##    to the existing count files (targets that are no longer given are removed)
+## -> with several Workers or the Fragments (list of fragment files of the neighbors file), the
+##    neighbors are counted in partitions of whole genes in separate processes (see CountPartitions)
+## -> the counts per taxon are exported for each of the Levels (e.g. ["Phylum"], see CountTaxonomy)
+## -> the counts per position of each entry are saved as hits (Ref, Pos, Target, Count), or as
+##    table with one column per target and position (Dense=True)
+## -> returns the counts as saved
+def CountNeighbors(OutputPath, TargetDict, FileType, Sep, Ask, Workers=1, Fragments=None, 
+	PartitionRows=500000, Levels=None, Dense=False, Session=None):
+	InfoFile = OutputPath + "_CountInfo.json"
+	CountFiles = [OutputPath + Name + FileType 
+		for Name in ("_RangeCount", "_EntryCount", "_PositionCount")]
+	TargetColumns = FT.GetTargetColumns(TargetDict)
+	State = [IE.GetFileState(File) for File in Fragments or [OutputPath + FileType]]
+	Info = IE.ReadManifest(InfoFile)
+	Counted = []
+	if Info is not None and Info["Neighbors"] == State and Info.get("Dense", True) == Dense \
+		and all(os.path.exists(File) for File in CountFiles):
+		Counted = [Column for Column in Info["Targets"] if Column in TargetColumns]
+	NewDict = {TargetType: [Target for Target in TargetDict[TargetType] 
+		if FT.GetTargetColumns({TargetType: [Target]})[0] not in Counted] 
+		for TargetType in TargetDict}
+	NewCounts = None
+	if Counted:
+		print(f"Add {len(TargetColumns) - len(Counted)} new targets to the existing counts of "
+			f"{len(Counted)} targets")
+		with Metrics.Stage("Import counts"):
+			Counts = (IE.ImportDataFrame(CountFiles[0], Sep), IE.ImportDataFrame(CountFiles[1], Sep),
+				FT.SparsePositionCount(IE.ImportPositionCount(CountFiles[2], Sep)) if Dense 
+				else IE.ImportDataFrame(CountFiles[2], Sep))
+	if (not Counted or any(NewDict.values())) and (Workers > 1 or Fragments):
+		with Metrics.Stage("Count partitions"):
+			NewCounts = CountPartitions(Fragments or OutputPath + FileType, NewDict, Sep, Workers, 
+				PartitionRows)
+	elif not Counted or any(NewDict.values()):
+
+		# Only load the columns needed for counting the (new) targets
+		with Metrics.Stage("Import neighbors"):
+			ProteinData = IE.ImportDataFrame(OutputPath + FileType, Sep, GetCountColumns(NewDict))
+		ProteinData.drop(ProteinData.index[ProteinData["Status"] == "Error"], inplace = True)
+
+		# Match all targets and count them per position, per entry and per position of each entry
+		with Metrics.Stage("Match targets"):
+			Matrix = FT.MatchTargets(ProteinData, NewDict)
+		with Metrics.Stage("Count targets"):
+			NewCounts = FT.CountTargets(ProteinData, Matrix)
+	if Counted:
+		with Metrics.Stage("Count targets"):
+			RangeCount, EntryCount, PositionCount = FT.MergeCounts(Counts, NewCounts, 
+				TargetColumns)
+	else:
+		RangeCount, EntryCount, PositionCount = NewCounts
+	print(f"\nFOUND TARGETS\n{RangeCount}\n\n")
+
+	# Count the targets per taxon of the reference genes (from the hits of each entry)
+	Counts = (RangeCount, EntryCount, PositionCount)
+	for Level in Levels or []:
+		with Metrics.Stage("Count taxonomy"):
+			TaxonomyCount = CountTaxonomy(Counts, Level, Session)
+		IE.ExportDataFrame(TaxonomyCount, OutputPath + "_" + Level + "Count", 
+			FileType=FileType, Sep=Sep, Ask=Ask)
+	if Dense:
+		with Metrics.Stage("Count targets"):
+			PositionCount = FT.DensePositionCount(Counts)
+	with Metrics.Stage("Export counts"):
+		Saved = [IE.ExportDataFrame(Table, File[:-len(FileType)], FileType=FileType, Sep=Sep, 
+			Ask=Ask) for Table, File in zip((RangeCount, EntryCount, PositionCount), CountFiles)]
+
+	# The targets can only be added to the count files if they were saved under their names
+	if Saved == CountFiles:
+		IE.WriteManifest(InfoFile, {"Neighbors": State, "Targets": TargetColumns, "Dense": Dense})
+	elif os.path.exists(InfoFile):
+		os.remove(InfoFile)
+	return(RangeCount, EntryCount, PositionCount)
+
+
+## ================================================================================================
+## Count the targets per taxon of the reference genes at each position (Counts of CountTargets)
+## -> Level of the lineage (Kingdom, Phylum, Class, Order), unknown organisms are "Unknown"
+def CountTaxonomy(Counts, Level, Session=None):
+	Lookup = KEGG.LoadTaxonomy(Session).GetLevel(Level)
+	orgIDs = Counts[1]["Ref"].str.split(":", n=1).str[0]
+	return(FT.CountTaxonomy(Counts, orgIDs.map(Lookup).fillna("Unknown"), Level))
+
+
+## ================================================================================================
+## Get the columns needed for counting the targets (dict of Type:[Targets])
+def GetCountColumns(TargetDict):
+	return(["Ref", "Pos", "Status"] + [TargetType for TargetType in TargetDict 
+		if TargetDict[TargetType]])
+
+
+## ================================================================================================
+## Count the targets in partitions of the neighbors in several processes and combine the counts
+## -> Source: list of fragment files (one partition each) or the neighbors file (read in
+##    partitions of about PartitionRows rows with whole genes)
+## -> only about two partitions per worker are loaded at once, so that the memory needed depends
+##    on the size of the partitions and not of the neighbors file
+## -> without processes started by fork (e.g. on Windows), the partitions are counted one by one
+def CountPartitions(Source, TargetDict, Sep, Workers=1, PartitionRows=500000):
+	if isinstance(Source, str):
+		Partitions = IterPartitions(Source, Sep, GetCountColumns(TargetDict), PartitionRows)
+	else:
+		Partitions = iter(Source)
+	Parts = []
+	if Workers > 1 and "fork" in multiprocessing.get_all_start_methods():
+		print(f"Count the targets in partitions with {Workers} processes . . .")
+		with ProcessPoolExecutor(max_workers=Workers, 
+			mp_context=multiprocessing.get_context("fork")) as Executor:
+			Running = set()
+			for Partition in Partitions:
+				if len(Running) >= Workers * 2:
+					Done, Running = wait(Running, return_when=FIRST_COMPLETED)
+					Parts.extend(Future.result() for Future in Done)
+				Running.add(Executor.submit(CountPartition, Partition, TargetDict, Sep))
+			Parts.extend(Future.result() for Future in Running)
+	else:
+		Parts = [CountPartition(Partition, TargetDict, Sep) for Partition in Partitions]
+	Metrics.Count("Partitions counted", len(Parts))
+	Parts = [Part for Part in Parts if Part is not None]
+	if not Parts:
+		Empty = pd.DataFrame(columns=GetCountColumns(TargetDict))
+		return(FT.CountTargets(Empty, FT.MatchTargets(Empty, TargetDict)))
+	return(FT.CombineCounts(Parts, FT.GetTargetColumns(TargetDict)))
+
+
+## ================================================================================================
+## Count the targets of one partition (dataframe or fragment file) -> counts as CountTargets
+## -> genes with errors are removed, returns None if no neighbors are left
+def CountPartition(Partition, TargetDict, Sep=";"):
+	if isinstance(Partition, str):
+		Partition = IE.ImportDataFrame(Partition, Sep, GetCountColumns(TargetDict))
+	Partition = Partition[Partition["Status"] != "Error"]
+	if Partition.empty:
+		return(None)
+	Partition = Partition.assign(Pos=Partition["Pos"].astype("int64"))
+	return(FT.CountTargets(Partition, FT.MatchTargets(Partition, TargetDict)))
+
+
+## ================================================================================================
+## Read the neighbors file in partitions of whole genes (about Rows rows each)
+## -> the rows of the last gene of each part are moved to the next partition
+def IterPartitions(FileName, Sep, Columns, Rows=500000):
+	Rest = None
+	for Part in IE.IterDataFrame(FileName, Sep, Columns, Rows):
+		if Rest is not None:
+			Part = pd.concat([Rest, Part], ignore_index=True)
+		Refs = Part["Ref"].to_numpy()
+		End = len(Refs)
+		while End > 0 and Refs[End-1] == Refs[-1]:
+			End -= 1
+		Rest = Part.iloc[End:]
+		if End:
+			yield(Part.iloc[:End])
+	if Rest is not None and len(Rest):
+		yield(Rest)
+
+
+## ================================================================================================
+## Get the fragment files of a download (FilePath of the fragments, listed in the manifest)
+## -> returns None if there is no manifest or a fragment is missing
+def GetFragments(FilePath):
+	Manifest = IE.ReadManifest(FilePath + "_Manifest.json")
+	if Manifest is None:
+		return(None)
+	Fragments = [os.path.join(os.path.dirname(FilePath), File) for File in Manifest["Fragments"]]
+	if not all(os.path.exists(File) for File in Fragments):
+		return(None)
+	return(Fragments)
+
+
+## ================================================================================================
+## Export the sequences of all neighbors that match a target (at the given positions) as FASTA
+## -> without targets, the sequences of all neighbors (at the given positions) are exported
+## -> the sequences are read from the sequence store (if it exists) or from the neighbors file
+## -> the header of each sequence lists the reference genes, positions and matched targets
+def ExportFasta(OutputPath, TargetDict, FileType, Sep, Ask, SequenceFile=None, Positions=None):
+	Store = None
+	if SequenceFile is not None and os.path.exists(SequenceFile + ".fasta"):
+		Store = SS.SequenceStore(SequenceFile, ReadOnly=True)
+	Columns = ["Ref", "ID", "Pos", "Status"] + [TargetType for TargetType in TargetDict 
+		if TargetDict[TargetType]]
+	if Store is None:
+		Columns.append("Sequence")
+	ProteinData = IE.ImportDataFrame(OutputPath + FileType, Sep, Columns)
+	ProteinData = ProteinData[ProteinData["Status"] != "Error"]
+	if Positions:
+		ProteinData = ProteinData[ProteinData["Pos"].isin(Positions)]
+
+	# Select all neighbors with a target and describe them (Ref/Pos of each occurrence, targets)
+	Matrix = FT.MatchTargets(ProteinData, TargetDict)
+	if Matrix.shape[1]:
+		Selected = Matrix.to_numpy().any(axis=1)
+		ProteinData, Matrix = ProteinData[Selected], Matrix[Selected]
+	TargetNames = Matrix.columns.to_numpy()
+	Descriptions = {}
+	for Row, Hits in zip(ProteinData.itertuples(index=False), Matrix.to_numpy().astype(bool)):
+		Description = f"{Row.Ref}/{int(Row.Pos)}"
+		if Hits.any():
+			Description += "(" + ",".join(TargetNames[Hits]) + ")"
+		Descriptions.setdefault(Row.ID, []).append(Description)
+	Descriptions = {GeneID: " ".join(Values) for GeneID, Values in Descriptions.items()}
+
+	if Store is not None:
+		Found = Store.Get(list(Descriptions))
+	elif "Sequence" in ProteinData.columns:
+		Found = dict(zip(ProteinData["ID"], ProteinData["Sequence"]))
+	else:
+		Found = {}
+	Sequences = {GeneID: Found[GeneID] for GeneID in Descriptions 
+		if isinstance(Found.get(GeneID), str)}
+	if len(Sequences) < len(Descriptions):
+		print(f"No sequence saved for {len(Descriptions) - len(Sequences)} of "
+			f"{len(Descriptions)} selected neighbors (e.g. downloaded with --nosequence)")
+	print(f"Export the sequences of {len(Sequences)} neighbors")
+	FileName = IE.CheckFileExists(OutputPath + "_Hits.fasta", Ask)
+	return(SS.WriteFasta(FileName, Sequences, Descriptions))
+
+
+## ================================================================================================
+## Set up dictionary of targets with Type:[Targets] (from comma-separated lists and target file)
+def GetTargets(targetID, targetDomain, targetName, targetFile, Sep):
+	TargetDict = {}
+	TargetDict = {"KO-ID": targetID, "Name": targetName, "Domain": targetDomain}
+	for Target in TargetDict:
+		if TargetDict[Target]:
+			TargetDict[Target] = TargetDict[Target].split(",")
+		else:
+			TargetDict[Target] = []
+	if targetFile != None:
+		with open(targetFile) as File:
+			for Line in File:
+				(Target, TargetType) = Line.strip().split(Sep)
+				try:
+					TargetDict[TargetType].append(Target)
+				except KeyError:
+					if TargetType != "Type":
+						print(f"\nDetected {TargetType} not in type list, will be ignored")
+	print(f"\nThe input targets are:\n{TargetDict}\n")
+	return(TargetDict)
+
+
+## ------------------------------------------------------------------------------------------------
+## ANALYZER CLASS ---------------------------------------------------------------------------------
+## ------------------------------------------------------------------------------------------------
+## ================================================================================================
+## Settings of an analysis and all steps as methods (same defaults as Main.py)
+## -> the connection, cache and taxonomy settings only apply to the downloads of this analyzer
+##    (kept in its Download_KEGG.KeggSession)
+class VicinityAnalyzer:
+	def __init__(self, Range=5, ClusterSize=25, FileType=".csv", Sep=";", Ask=False, 
+		Workers=1, RequestRate=3, KeggURL="https://rest.kegg.jp", Retries=4, Verify=True, 
+		NeighborMode="order", Sequences=True, SequenceStore=False, UseCache=True, 
+		CacheFile=Cache_KEGG.DefaultFile, CacheAge=30, CacheSize=2048, Offline=False, 
+		CountWorkers=1, PartitionRows=500000, DensePositions=False, 
+		TaxonomyFile=Taxonomy_KEGG.DefaultFile):
+		if Offline and not UseCache:
+			raise ValueError("The offline mode requires the cache")
+		self.Range = Range
+		self.ClusterSize = ClusterSize
+		self.FileType = FileType
+		self.Sep = Sep
+		self.Ask = Ask
+		self.Workers = Workers
+		self.CountWorkers = CountWorkers
+		self.PartitionRows = PartitionRows
+		self.DensePositions = DensePositions
+		self.UseOrder = NeighborMode == "order"
+		self.Fields = None
+		self.SequenceStore = SequenceStore and Sequences
+		if not Sequences:
+			self.Fields = tuple(Field for Field in KEGG.AllFields if Field != "Sequence")
+		self.Taxonomy = None
+		Transport = KEGG.KeggTransport(KeggURL, Retries, Verify=Verify, 
+			RequestsPerSecond=RequestRate)
+		if UseCache:
+			self.Session = KEGG.KeggSession(Transport, 
+				Cache_KEGG.EntryCache(CacheFile, CacheAge, CacheSize, Offline), TaxonomyFile, CacheAge)
+		else:
+			self.Session = KEGG.KeggSession(Transport)
+
+	## --------------------------------------------------------------------------------------------
+	## Get the list of gene IDs of a KO ID, a file or a (comma-separated) list of gene IDs
+	def RetrieveIDs(self, Input):
+		return(RetrieveIDs(Input, self.Sep, self.Session)[0])
+
+	## --------------------------------------------------------------------------------------------
+	## Download the neighbors of all genes -> yields one dataframe per cluster (no files saved)
+	def IterNeighbors(self, IDList):
+		for x in range(0, len(IDList), self.ClusterSize):
+			Neighbors = KEGG.DownloadCluster(IDList[x:x+self.ClusterSize], self.Range, 
+				self.Workers, self.UseOrder, self.Fields, Session=self.Session)
+			if self.Taxonomy is None:
+				self.Taxonomy = KEGG.DownloadTaxonomy(self.Session)
+			yield(BuildFragment(Neighbors, self.Taxonomy))
+
+	## --------------------------------------------------------------------------------------------
+	## Download the neighbors of all genes -> returns one dataframe (no files saved)
+	def FetchNeighbors(self, IDList):
+		return(pd.concat(list(self.IterNeighbors(IDList)), ignore_index=True))
+
+	## --------------------------------------------------------------------------------------------
+	## Download the neighbors of all genes into fragment files (FilePath + _1, _2, ...)
+	## -> can be resumed, returns the combined file (or the fragment list if OutputPath=None)
+	## -> with SequenceStore, the sequences are saved in SequenceFile (default: FilePath_Sequences)
+	def GetNeighbors(self, IDList, FilePath, OutputPath=None, RetryErrors=False, 
+		SequenceFile=None):
+		if self.SequenceStore and SequenceFile is None:
+			SequenceFile = FilePath + "_Sequences"
+		return(GetNeighbors(IDList, FilePath, OutputPath, self.Range, self.FileType, self.Sep, 
+			self.Ask, self.ClusterSize, self.Workers, self.UseOrder, self.Fields, RetryErrors, 
+			SequenceFile if self.SequenceStore else None, self.Session))
+
+	## --------------------------------------------------------------------------------------------
+	## Count the targets (dict of Type:[Targets]) in a dataframe of neighbors
+	## -> returns the counts per position, per entry and per position of each entry (as hits,
+	##    see DensePositionCount for the table)
+	def CountTargets(self, ProteinData, TargetDict):
+		ProteinData = ProteinData[ProteinData["Status"] != "Error"]
+		Matrix = FT.MatchTargets(ProteinData, TargetDict)
+		return(FT.CountTargets(ProteinData, Matrix))
+
+	## --------------------------------------------------------------------------------------------
+	## Count the targets in a neighbors file (without file type) and export the count files
+	## -> Fragments: count the fragment files of the neighbors file instead (see GetFragments)
+	## -> Levels: export the counts per taxon of these levels of the lineage (e.g. ["Phylum"])
+	def CountNeighbors(self, OutputPath, TargetDict, Fragments=None, Levels=None):
+		return(CountNeighbors(OutputPath, TargetDict, self.FileType, self.Sep, self.Ask, 
+			self.CountWorkers, Fragments, self.PartitionRows, Levels, self.DensePositions, 
+			self.Session))
+
+	## --------------------------------------------------------------------------------------------
+	## Count the targets per taxon (Level: Kingdom, Phylum, Class or Order) at each position
+	## -> from the counts returned by CountTargets
+	def CountTaxonomy(self, Counts, Level="Phylum"):
+		return(CountTaxonomy(Counts, Level, self.Session))
+
+	## --------------------------------------------------------------------------------------------
+	## Get the counts per position of each entry as table (one column per target and position)
+	def DensePositionCount(self, Counts):
+		return(FT.DensePositionCount(Counts))
+
+	## --------------------------------------------------------------------------------------------
+	## Export the sequences of the neighbors matching a target (at the positions) as FASTA
+	def ExportFasta(self, OutputPath, TargetDict, SequenceFile=None, Positions=None):
+		return(ExportFasta(OutputPath, TargetDict, self.FileType, self.Sep, self.Ask, 
+			SequenceFile, Positions))
+
+	## --------------------------------------------------------------------------------------------
+	## Close the connections to KEGG and the cache (at the end of the program)
+	def Close(self):
+		self.Session.Close()